@@ -1,22 +1,16 @@
+import gc
 from collections import defaultdict
 from timeit import default_timer as timer
+from typing import TYPE_CHECKING
 
-import torch
 from loguru import logger
-from transformers import AutoModelForCausalLM, LlamaForCausalLM, AutoTokenizer, LlamaTokenizer
-from transformers import StoppingCriteria, StoppingCriteriaList
 
+from app.kv_cache import KvCacheManager, get_kv_bytes_per_token, get_quantized_cache_config
 from app.util import ModelConfig
 
-
-class KeywordsStoppingCriteria(StoppingCriteria):
-    def __init__(self, keywords_ids: list):
-        self.keywords_ids = keywords_ids
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if input_ids[0][-1] in self.keywords_ids:
-            return True
-        return False
+# torch and transformers are imported where they are first needed, so that importing the server stays fast
+if TYPE_CHECKING:
+    from transformers import StoppingCriteriaList
 
 
 class Llm:
@@ -37,7 +31,7 @@ class Llm:
         'falcon-instruct-small': {'model': 'tiiuae/falcon-7b-instruct', 'trust_remote_code': True},
         'falcon-instruct-large': {'model': 'tiiuae/falcon-40b-instruct', 'trust_remote_code': True},
         'falcon-large': {'model': 'tiiuae/falcon-40b', 'trust_remote_code': True},
-        'mpnet-v2': {'model': 'sentence-transformers/all-mpnet-base-v2'},
+        'mpnet-v2': {'model': 'sentence-transformers/all-mpnet-base-v2', 'task': 'embedding'},
         'starcoder': {'model': 'bigcode/starcoder'},
         'testing': {'model': 'gpt2'},
         'upstage-llama2': {'model': 'upstage/Llama-2-70b-instruct-v2'},
@@ -52,9 +46,13 @@ class Llm:
 
     generation_config_overrides = {'falcon': {'ignore': ['stop']}}
 
-    bitsize_map = {8: {'load_in_8bit': True, 'torch_dtype': torch.float16},
-                   16: {'torch_dtype': torch.bfloat16},
-                   32: {'torch_dtype': torch.float}}
+    warmup_prompts = {'code': 'def fibonacci(n):\n    ',
+                      'chat': '### user: How do I read a file line by line in Python?\n### assistant:'}
+    warmup_max_new_tokens = 16
+
+    bitsize_map = {8: {'load_in_8bit': True, 'torch_dtype': 'float16'},
+                   16: {'torch_dtype': 'bfloat16'},
+                   32: {'torch_dtype': 'float32'}}
 
     def __init__(self, config: ModelConfig):
         self.prev_time = timer()
@@ -66,10 +64,19 @@ class Llm:
         self.model_config = self.get_model_config(config.model_name, config.bitsize)
         self.stopping_criteria_config = {}
         self.stop_ids = []
+        self.offload_device = None
+        self.layer_report = config.layer_report
+        self.warmup_enabled = config.warmup
+        self.warmup_time = 0.0
+        self.prompt_buckets = sorted(config.prompt_buckets)
+        self.kv_cache_manager: KvCacheManager | None = KvCacheManager.from_config(config)
+        self.kv_cache_generation_config = get_quantized_cache_config(config.kv_cache_dtype)
+        self.kv_prompt_truncation = config.kv_prompt_truncation
+        self.kv_bytes_per_token = None
+        self.model = None
         self.load_tokenizer()
         # load model should be the last action, so that get_timing returns the load time if called after Llm()
         if config.do_not_load_llm:
-            self.model = None
             return
         self.load_model(config.bitsize)
 
@@ -78,16 +85,23 @@ class Llm:
         config.update(Llm.bitsize_map[bitsize])
         return config
 
+    @staticmethod
+    def get_torch_dtype(dtype_name: str):
+        import torch
+        return getattr(torch, dtype_name)
+
     def get_model_parameters(self, bitsize):
+        from transformers import AutoModelForCausalLM, LlamaForCausalLM
         model_id = self.model_config['model']
         model_loader_class = AutoModelForCausalLM if "llama" not in model_id.lower() else LlamaForCausalLM
         model_loader = model_loader_class.from_pretrained
 
-        params = {"device_map": self.get_device_map()}
+        # low_cpu_mem_usage memory-maps safetensors checkpoints instead of materializing a randomly initialized copy first
+        params = {"device_map": self.get_device_map(), "low_cpu_mem_usage": True}
         for param, value in self.model_config.items():
-            if param == 'model':
+            if param in ('model', 'task'):
                 continue
-            params[param] = value
+            params[param] = self.get_torch_dtype(value) if param == 'torch_dtype' else value
         if bitsize == 8:
             params['load_in_8bit'] = True
         if bitsize == 4:
@@ -95,6 +109,14 @@ class Llm:
         return model_loader, model_id, params
 
     def load_model(self, bitsize):
+        if self.model is not None and self.offload_device is None:
+            return
+        if self.model is not None:
+            self.timeit()
+            self.model.to(self.offload_device)
+            self.offload_device = None
+            self.timeit("restore offloaded model")
+            return
         model_loader, model_id, params = self.get_model_parameters(bitsize)
         logger.debug(f"loading model {model_id} using these parameters: {params}")
         self.timeit()
@@ -104,11 +126,66 @@ class Llm:
         self.max_position_embeddings = None
         if hasattr(self.model.config, 'max_position_embeddings'):
             self.max_position_embeddings = self.model.config.max_position_embeddings
+        self.kv_bytes_per_token = self.get_kv_bytes_per_token()
 
         logger.debug(self.model.hf_device_map)
-        self.print_model_layer_information()
+        if self.layer_report:
+            self.print_model_layer_information()
+        if self.warmup_enabled:
+            self.warmup()
+
+    def warmup(self):
+        # run the first requests' kernel selection, allocator growth and compilation before serving traffic
+        start = timer()
+        generation_config = {'max_new_tokens': self.warmup_max_new_tokens, 'do_sample': False}
+        for prompt in Llm.warmup_prompts.values():
+            self.generate(prompt, generation_config)
+        prompt_ids = self.tokenizer(Llm.warmup_prompts['code'], return_token_type_ids=False)['input_ids']
+        for bucket in self.prompt_buckets:
+            max_sequence_length = self.get_max_sequence_length()
+            if max_sequence_length is not None and bucket + self.warmup_max_new_tokens > max_sequence_length:
+                break
+            # bucketed prompts are left padded anyway, so any prompt that fits the bucket warms up its shape
+            token_ids = (prompt_ids * (bucket // len(prompt_ids) + 1))[-bucket:]
+            self.generate_from_token_ids(token_ids, generation_config, [])
+        self.warmup_time = timer() - start
+        logger.info(f"warmup of {self.model_name} took {self.warmup_time:.2f}s")
+
+    def get_kv_bytes_per_token(self) -> int | None:
+        import torch
+        element_size = 1 if self.kv_cache_generation_config else torch.tensor([], dtype=self.model.dtype).element_size()
+        try:
+            return get_kv_bytes_per_token(self.model.config, element_size)
+        except AttributeError:
+            logger.warning(f"unknown KV cache layout of {self.model_name}, requests are not accounted")
+            return None
+
+    def unload_model(self, offload_to_cpu: bool = False):
+        if self.model is None or self.offload_device is not None:
+            return
+        self.timeit()
+        devices = set(getattr(self.model, 'hf_device_map', {}).values())
+        model_device = next(self.model.parameters()).device
+        # models split across devices or quantized by bitsandbytes cannot be moved as a whole
+        if offload_to_cpu and model_device.type != 'cpu' and len(devices) <= 1 \
+                and not getattr(self.model, 'is_loaded_in_8bit', False):
+            self.model.to('cpu')
+            self.offload_device = model_device
+        else:
+            self.model = None
+        gc.collect()
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.timeit("offload model" if self.offload_device is not None else "unload model")
+
+    def memory_footprint(self) -> int:
+        if self.model is None or self.offload_device is not None:
+            return 0
+        return self.model.get_memory_footprint()
 
     def load_tokenizer(self):
+        from transformers import AutoTokenizer, LlamaTokenizer
         model_id = self.model_config['model']
         tokenizer_loader = LlamaTokenizer.from_pretrained if "llama" in model_id.lower() else AutoTokenizer.from_pretrained
         self.timeit()
@@ -121,32 +198,32 @@ class Llm:
     def add_stopwords(self, stop_word_list):
         self.stopping_criteria_config = {'stopping_criteria': self.get_stopping_criteria_list(stop_word_list)}
 
-    def get_stopping_criteria_list(self, stop_word_list) -> StoppingCriteriaList:
+    def get_stopping_criteria_list(self, stop_word_list) -> 'StoppingCriteriaList':
         stop_encoded = [self.tokenizer.encode(w) for w in stop_word_list]
-        self.stop_ids = [encoded[0] for encoded in stop_encoded]
+        return self.get_stopping_criteria_list_from_ids([encoded[0] for encoded in stop_encoded])
+
+    def get_stopping_criteria_list_from_ids(self, stop_ids: list) -> 'StoppingCriteriaList':
+        from transformers import StoppingCriteriaList
+        from app.stopping_criteria import KeywordsStoppingCriteria
+        self.stop_ids = stop_ids
         stopping_criteria = KeywordsStoppingCriteria(self.stop_ids)
         return StoppingCriteriaList([stopping_criteria])
 
     def print_model_layer_information(self):
         size_dict = defaultdict(int)
         device_dict = defaultdict(set)
-        layer_names = []
+        device_size_dict = defaultdict(int)
         for name, param in self.model.named_parameters():
-            layer_parts = name.split(".")
-            layer_name = ".".join(layer_parts[0:3])
-            if layer_name not in layer_names:
-                layer_names.append(layer_name)
+            layer_name = ".".join(name.split(".")[0:3])
             size_dict[layer_name] += param.numel()
             device_dict[layer_name].add(param.device)
-        for layer_name in layer_names:
-            logger.debug(
-                f"Layer: {layer_name}: {size_dict[layer_name] / 1024 ** 2:.3f} MB on device {device_dict[layer_name]}")
-        devices = {device for device_set in device_dict.values() for device in device_set}
-        for device in devices:
-            logger.debug(
-                f"Used GPU mem: {sum([param.numel() for _, param in self.model.named_parameters() if device == param.device]) / 1024 ** 3:.3f} GB on {device}")
-        if len(devices) > 1:
-            logger.debug(f"Used GPU mem: {sum(size_dict[l] for l in size_dict.keys()) / 1024 ** 3:.3f} GB in total")
+            device_size_dict[param.device] += param.numel()
+        for layer_name, size in size_dict.items():
+            logger.debug(f"Layer: {layer_name}: {size / 1024 ** 2:.3f} MB on device {device_dict[layer_name]}")
+        for device, size in device_size_dict.items():
+            logger.debug(f"Used GPU mem: {size / 1024 ** 3:.3f} GB on {device}")
+        if len(device_size_dict) > 1:
+            logger.debug(f"Used GPU mem: {sum(size_dict.values()) / 1024 ** 3:.3f} GB in total")
 
     def strip_inputs_and_stopwords(self, outputs, input_ids):
         # remove the last token, if it was a stopping token
@@ -173,14 +250,81 @@ class Llm:
                 ignore_list += overrides['ignore']
         return {k: v for k, v in generation_config.items() if k not in ignore_list}
 
-    def generate_from_ids(self, inputs, generation_config: dict, stopping_criteria_list: StoppingCriteriaList = None,
+    @staticmethod
+    def get_bucket(value: int, buckets: list) -> int:
+        return next((bucket for bucket in buckets if bucket >= value), value)
+
+    def get_max_sequence_length(self) -> int | None:
+        # prompt and generated tokens must fit the positions, the prompt truncation limit and the KV cache budget
+        limits = [self.max_position_embeddings, self.kv_prompt_truncation]
+        if self.kv_cache_manager is not None and self.kv_bytes_per_token is not None:
+            limits.append(self.kv_cache_manager.get_max_tokens(self.kv_bytes_per_token))
+        limits = [limit for limit in limits if limit]
+        return min(limits) if limits else None
+
+    def pad_to_bucket(self, inputs, generation_tokens: int) -> tuple:
+        import torch.nn.functional
+        input_ids = inputs['input_ids']
+        bucket = self.get_bucket(len(input_ids[0]), self.prompt_buckets)
+        # the padding must leave room for the generated tokens, otherwise padding alone could overflow the limit
+        max_sequence_length = self.get_max_sequence_length()
+        if max_sequence_length is not None:
+            bucket = min(bucket, max_sequence_length - generation_tokens)
+        padding = bucket - len(input_ids[0])
+        if padding <= 0:
+            return inputs, 0
+        attention_mask = inputs.get('attention_mask')
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # left padding keeps the generated tokens at the end, the attention mask hides the padding from the model
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        padded_inputs = {'input_ids': torch.nn.functional.pad(input_ids, (padding, 0), value=pad_token_id),
+                         'attention_mask': torch.nn.functional.pad(attention_mask, (padding, 0), value=0)}
+        return padded_inputs, padding
+
+    def get_generation_tokens(self, generation_config: dict) -> int:
+        return generation_config.get('max_new_tokens') or self.model.generation_config.max_new_tokens or 20
+
+    def reserve_kv_cache(self, input_tokens: int, padding: int, generation_config: dict) -> tuple:
+        # returns the reserved bytes, or a message explaining why the request was not admitted;
+        # padding never goes past the budget, so it cannot get a request rejected or shortened
+        if self.kv_cache_manager is None or self.kv_bytes_per_token is None:
+            return None, None
+        max_tokens = self.kv_cache_manager.get_max_tokens(self.kv_bytes_per_token)
+        generation_tokens = self.get_generation_tokens(generation_config)
+        if max_tokens is not None and input_tokens + padding + generation_tokens > max_tokens:
+            if input_tokens + padding >= max_tokens:
+                logger.debug(f"ignoring request: {input_tokens} tokens exceed the KV cache budget of {max_tokens}")
+                return None, f"input sequence too long for the KV cache budget {input_tokens} > {max_tokens}"
+            generation_tokens = max_tokens - input_tokens - padding
+            generation_config['max_new_tokens'] = generation_tokens
+        reservation = self.kv_cache_manager.reserve(input_tokens + padding + generation_tokens,
+                                                    self.kv_bytes_per_token)
+        if reservation is None:
+            return None, "server busy: KV cache budget exhausted, please retry"
+        return reservation, None
+
+    def generate_from_ids(self, inputs, generation_config: dict, stopping_criteria_list: 'StoppingCriteriaList' = None,
                           remove_prompt_from_reply: bool = True) -> tuple:
         input_ids = inputs['input_ids']
         prompt_tokens = len(input_ids[0])
         generation_config = self.update_generation_config(generation_config)
         self.timeit()
         if self.model is not None:
-            if self.max_position_embeddings is not None and prompt_tokens > self.max_position_embeddings:
+            generation_tokens = self.get_generation_tokens(generation_config)
+            if self.kv_prompt_truncation and prompt_tokens + generation_tokens > self.kv_prompt_truncation:
+                if generation_tokens >= self.kv_prompt_truncation:
+                    logger.debug(f"ignoring request: max_new_tokens {generation_tokens} exceed the prompt truncation "
+                                 f"limit {self.kv_prompt_truncation}")
+                    return self.tokenize(f"max_new_tokens too large for the prompt truncation limit "
+                                         f"{generation_tokens} >= {self.kv_prompt_truncation}")[
+                        'input_ids'], prompt_tokens, 0
+                # the start of the prompt is dropped, so that the prompt and the generated tokens fit the limit
+                keep = self.kv_prompt_truncation - generation_tokens
+                logger.debug(f"prompt truncation: keeping the last {keep} of {prompt_tokens} prompt tokens")
+                inputs = {key: value[:, -keep:] for key, value in inputs.items()}
+                input_ids = inputs['input_ids']
+            if self.max_position_embeddings is not None and len(input_ids[0]) > self.max_position_embeddings:
                 logger.debug(
                     f"ignoring request: input sequence too long {prompt_tokens} > {self.max_position_embeddings}")
                 return self.tokenize(f"input sequence too long {prompt_tokens} > {self.max_position_embeddings}")[
@@ -193,8 +337,18 @@ class Llm:
                 stopping_criteria_config = {}
             # if self.stopping_criteria_config is not None:
             #    stopping_criteria_config = self.stopping_criteria_config
-            outputs = self.model.generate(**inputs, **generation_config, **stopping_criteria_config,
-                                          pad_token_id=self.tokenizer.eos_token_id)
+            padded_inputs, padding = self.pad_to_bucket(inputs, self.get_generation_tokens(generation_config))
+            reservation, message = self.reserve_kv_cache(len(input_ids[0]), padding, generation_config)
+            if message is not None:
+                return self.tokenize(message)['input_ids'], prompt_tokens, 0
+            try:
+                outputs = self.model.generate(**padded_inputs, **generation_config, **stopping_criteria_config,
+                                              **self.kv_cache_generation_config,
+                                              pad_token_id=self.tokenizer.eos_token_id)
+            finally:
+                if reservation is not None:
+                    self.kv_cache_manager.release(reservation)
+            outputs = outputs[:, padding:]
         else:
             outputs = input_ids
         self.timeit(f"inference {prompt_tokens}/{len(outputs[0]) - prompt_tokens}")
@@ -203,7 +357,7 @@ class Llm:
         completion_tokens = len(outputs[0])
         return outputs, prompt_tokens, completion_tokens
 
-    def generate(self, prompt: str, generation_config: dict, stopping_criteria_list: StoppingCriteriaList = None,
+    def generate(self, prompt: str, generation_config: dict, stopping_criteria_list: 'StoppingCriteriaList' = None,
                  remove_prompt_from_reply: bool = True) -> tuple:
         if self.model is None:
             return "Testing without LLM", 0, 0
@@ -217,6 +371,23 @@ class Llm:
             answer[0] = prompt + answer[0]
         return answer[0], prompt_tokens, completion_tokens
 
+    async def generate_async(self, prompt: str, generation_config: dict,
+                             stopping_criteria_list: 'StoppingCriteriaList' = None,
+                             remove_prompt_from_reply: bool = True) -> tuple:
+        # a single model instance serves one request at a time, so inference runs on the event loop as before
+        return self.generate(prompt, generation_config, stopping_criteria_list, remove_prompt_from_reply)
+
+    def generate_from_token_ids(self, token_ids: list, generation_config: dict, stop_ids: list,
+                                remove_prompt_from_reply: bool = True) -> tuple:
+        import torch
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        inputs = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}
+        stopping_criteria_list = self.get_stopping_criteria_list_from_ids(stop_ids) if stop_ids else None
+        outputs, prompt_tokens, completion_tokens = self.generate_from_ids(inputs, generation_config,
+                                                                           stopping_criteria_list,
+                                                                           remove_prompt_from_reply)
+        return outputs[0].tolist(), prompt_tokens, completion_tokens
+
     def timeit(self, label=None):
         cur_time = timer()
         self.delta_t = cur_time - self.prev_time
@@ -0,0 +1,72 @@
+import threading
+from timeit import default_timer as timer
+
+from loguru import logger
+
+from app.Llm import Llm
+
+
+class Embedder:
+    def __init__(self, model_name: str, device: str = "cpu", max_length: int | None = None):
+        assert Llm.models.get(model_name, {}).get('task') == 'embedding', \
+            f"{model_name} is not an embedding model.\nchose one of: " \
+            f"{[key for key, value in Llm.models.items() if value.get('task') == 'embedding']}"
+        self.model_name = model_name
+        self.device = device
+        self.max_length = max_length
+        self.tokenizer = None
+        self.model = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.model is not None:
+                return
+            from transformers import AutoModel, AutoTokenizer
+            model_id = Llm.models[self.model_name]['model']
+            start = timer()
+            self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+            self.model = AutoModel.from_pretrained(model_id).to(self.device).eval()
+            if self.max_length is None:
+                # some tokenizers report a huge placeholder as their maximum, the position embeddings are the real limit
+                self.max_length = min(self.tokenizer.model_max_length,
+                                      getattr(self.model.config, 'max_position_embeddings', None) or 512)
+            logger.info(f"loaded embedding model {model_id} in {timer() - start:.2f}s")
+
+    def pool(self, features):
+        # mean pooling over the non-padding tokens, normalized so that a dot product is the cosine similarity
+        import torch
+        features = features.to(self.device)
+        hidden_states = self.model(**features).last_hidden_state
+        mask = features['attention_mask'].unsqueeze(-1).to(hidden_states.dtype)
+        pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(pooled, dim=-1).float().cpu()
+
+    def embed(self, texts: list[str], max_length: int | None = None):
+        import torch
+        self.load()
+        with self._lock, torch.inference_mode():
+            return self.pool(self.tokenizer(texts, padding=True, truncation=True,
+                                            max_length=max_length or self.max_length, return_tensors="pt"))
+
+    def is_truncated(self, text: str) -> bool:
+        return len(self.tokenizer.tokenize(text)) + self.tokenizer.num_special_tokens_to_add() > self.max_length
+
+    def embed_batched(self, texts: list[str], batch_size: int) -> tuple:
+        import torch
+        self.load()
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        lengths = [len(input_ids) for input_ids in encoded['input_ids']]
+        # only inputs that reached the maximum length can have been cut off
+        truncated = sum(1 for text, length in zip(texts, lengths)
+                        if length == self.max_length and self.is_truncated(text))
+        # batching inputs of similar length keeps the padding, and with it the wasted compute, small
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        embeddings = torch.empty((len(texts), self.model.config.hidden_size), dtype=torch.float)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            features = self.tokenizer.pad({key: [encoded[key][i] for i in batch] for key in encoded.keys()},
+                                          return_tensors="pt")
+            with self._lock, torch.inference_mode():
+                embeddings[batch] = self.pool(features)
+        return embeddings, sum(lengths), truncated
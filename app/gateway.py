@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import http.client
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+_FORWARDED_HEADERS = ('authorization', 'content-type', 'accept')
+_CLIENT_HOST_HEADER = 'x-forwarded-for'
+
+
+class GatewayException(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class Backend:
+    def __init__(self, url: str, pool_size: int = 16, timeout: float = 600.0, status_timeout: float = 2.0):
+        self.url = url.rstrip('/')
+        self.pool_size = pool_size
+        parts = urlsplit(self.url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.status_timeout = status_timeout
+        self._connections: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        self._lock: threading.Lock = threading.Lock()
+        self.healthy = True
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.failures = 0
+        self.last_status_time = 0.0
+
+    def load(self) -> int:
+        return self.queue_depth + self.in_flight
+
+    def _get_connection(self) -> http.client.HTTPConnection:
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _put_connection(self, connection: http.client.HTTPConnection):
+        try:
+            self._connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method: str, path: str, body: bytes | None, headers: dict) -> tuple[int, str, bytes]:
+        # connections are kept alive and reused; a stale pooled connection is retried once with a fresh one
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt == 1:
+                    raise
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            return response.status, response.getheader('content-type', 'application/json'), content
+
+    def status_request(self, path: str, headers: dict) -> tuple[int, bytes]:
+        # a short-lived connection with a short timeout, so a hung backend cannot hold up queue depth updates
+        connection = self.connection_class(self.host, self.port, timeout=self.status_timeout)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def mark_failed(self):
+        with self._lock:
+            self.failures += 1
+            self.healthy = False
+
+    def status(self) -> dict:
+        return {'url': self.url, 'healthy': self.healthy, 'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight, 'failures': self.failures}
+
+
+class Gateway:
+    poll_interval = 1.0
+    max_imbalance = 4
+
+    def __init__(self, backend_urls: list[str], auth_token: str):
+        assert backend_urls, "gateway mode needs at least one backend"
+        self.backends = [Backend(url) for url in backend_urls]
+        self.auth_token = auth_token
+        self._lock: threading.Lock = threading.Lock()
+        # forwards hold a thread for a whole generation, so they get their own executor sized to the connection pools
+        self._forward_executor = ThreadPoolExecutor(max_workers=sum(backend.pool_size for backend in self.backends),
+                                                    thread_name_prefix="gateway-forward")
+        self._poll_executor = ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix="gateway-poll")
+
+    @staticmethod
+    def affinity_score(client_id: str, backend: Backend) -> bytes:
+        return hashlib.blake2b(f"{client_id}|{backend.url}".encode(), digest_size=8).digest()
+
+    def rank_backends(self, client_id: str) -> list[Backend]:
+        with self._lock:
+            healthy = [backend for backend in self.backends if backend.healthy] or list(self.backends)
+            by_load = sorted(healthy, key=Backend.load)
+            # rendezvous hashing keeps a client on the same node, unless that node is far busier than the idlest one
+            affine = max(healthy, key=lambda backend: self.affinity_score(client_id, backend))
+            if affine.load() - by_load[0].load() > self.max_imbalance:
+                return by_load
+            return [affine] + [backend for backend in by_load if backend is not affine]
+
+    def forward(self, client_id: str, client_host: str, path: str, body: bytes,
+                headers: dict) -> tuple[int, str, bytes]:
+        headers = {k: v for k, v in headers.items() if k.lower() in _FORWARDED_HEADERS}
+        # backends identify clients by token and host; without this every client would share the gateway's host
+        headers[_CLIENT_HOST_HEADER] = client_host
+        for backend in self.rank_backends(client_id):
+            with self._lock:
+                backend.in_flight += 1
+            try:
+                status, content_type, content = backend.request('POST', path, body, headers)
+            except (http.client.HTTPException, OSError) as e:
+                logger.warning(f"backend {backend.url} failed: {e}, failing over")
+                backend.mark_failed()
+                continue
+            finally:
+                with self._lock:
+                    backend.in_flight -= 1
+            if status >= 500:
+                logger.warning(f"backend {backend.url} answered {status}, failing over")
+                backend.mark_failed()
+                continue
+            logger.debug(f"forwarded {path} for client {client_id[-8:]} to {backend.url}")
+            return status, content_type, content
+        raise GatewayException("no backend available")
+
+    async def forward_async(self, client_id: str, client_host: str, path: str, body: bytes,
+                            headers: dict) -> tuple[int, str, bytes]:
+        return await asyncio.get_running_loop().run_in_executor(self._forward_executor, self.forward, client_id,
+                                                                client_host, path, body, headers)
+
+    def poll_backend(self, backend: Backend):
+        try:
+            status, content = backend.status_request('/status/', {'authorization': f"Bearer {self.auth_token}"})
+            if status != 200:
+                raise GatewayException(f"status {status}")
+            backend.queue_depth = json.loads(content).get('queue_depth', 0)
+            backend.last_status_time = time.time()
+            if not backend.healthy:
+                logger.info(f"backend {backend.url} is healthy again")
+            backend.healthy = True
+        except (http.client.HTTPException, OSError, ValueError, GatewayException) as e:
+            if backend.healthy:
+                logger.warning(f"backend {backend.url} status check failed: {e}")
+            backend.mark_failed()
+
+    async def poll_backend_forever(self, backend: Backend):
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(self._poll_executor, self.poll_backend, backend)
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll_backends(self):
+        # every backend is polled independently, so one slow node does not delay the others
+        await asyncio.gather(*[self.poll_backend_forever(backend) for backend in self.backends])
+
+    def status(self) -> list[dict]:
+        return [backend.status() for backend in self.backends]
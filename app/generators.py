@@ -1,3 +1,4 @@
+import asyncio
 import time
 import traceback
 from typing import List
@@ -8,7 +9,8 @@ from loguru import logger
 from app.Llm import Llm
 from app.model.api_models import ChatCompletionRequestPayload, ChatCompletionApiResponse, ChatCompletionApiChoice, ChatMessage, ApiUsage
 from app.model.api_models import CodingApiResponse, CodingRequestPayload, CodingParameters
-from app.model.api_models import GeneratorBase, GeneratorException
+from app.model.api_models import GeneratorBase, GeneratorException, ApiResponse, RequestPayload
+from app.model_manager import ModelManager
 
 
 class ChatGenerator(GeneratorBase):
@@ -51,8 +53,8 @@ class ChatGenerator(GeneratorBase):
     async def generate(self, request_payload: ChatCompletionRequestPayload) -> ChatCompletionApiResponse:
         try:
             prompt = self.chat_messages_to_prompt(request_payload.messages)
-            answer, prompt_tokens, completion_tokens = self.llm.generate(prompt, self.get_generation_config(request_payload),
-                                                                         remove_prompt_from_reply=True)
+            answer, prompt_tokens, completion_tokens = await self.llm.generate_async(prompt, self.get_generation_config(request_payload),
+                                                                                     remove_prompt_from_reply=True)
             answer = answer.lstrip()
             api_usage: ApiUsage = self.generate_api_usage(prompt_tokens, completion_tokens)
         except (RuntimeError, AttributeError) as e:
@@ -85,10 +87,36 @@ class CodeGenerator(GeneratorBase):
     async def generate(self, request_payload: CodingRequestPayload) -> CodingApiResponse:
         generation_config_dict, stopping_criteria_list = self.get_generation_config(request_payload=request_payload)
         try:
-            answer, prompt_tokens, completion_tokens = self.llm.generate(request_payload.inputs, generation_config_dict, stopping_criteria_list=stopping_criteria_list,
-                                                                         remove_prompt_from_reply=False)
+            answer, prompt_tokens, completion_tokens = await self.llm.generate_async(request_payload.inputs, generation_config_dict, stopping_criteria_list=stopping_criteria_list,
+                                                                                     remove_prompt_from_reply=False)
         except (RuntimeError, AttributeError) as e:
             logger.error(f"Llm code inference error: {str(e)}")
             logger.debug(f"Full stacktrace: \n{traceback.format_exc()}")
             raise GeneratorException("Internal error invoking the model. Please let us know that you are experiencing this error.")
         return self.generate_default_api_response(answer, 200)
+
+
+class ModelRoutingGenerator(GeneratorBase):
+    def __init__(self, generator_class: type[GeneratorBase], model_manager: ModelManager):
+        self.generator_class = generator_class
+        self.model_manager = model_manager
+        self.generators: dict[str, GeneratorBase] = {}
+
+    def generate_default_api_response(self, message: str, status: int) -> ApiResponse:
+        return self.generator_class.generate_default_api_response(message, status)
+
+    async def generate(self, request_payload: RequestPayload) -> ApiResponse:
+        model_name = self.model_manager.resolve(getattr(request_payload, 'model', None))
+        try:
+            llm = await asyncio.to_thread(self.model_manager.acquire, model_name)
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.error(f"loading model {model_name} failed: {str(e)}")
+            logger.debug(f"Full stacktrace: \n{traceback.format_exc()}")
+            raise GeneratorException(f"Model {model_name} could not be loaded.")
+        start = time.perf_counter()
+        try:
+            if model_name not in self.generators:
+                self.generators[model_name] = self.generator_class(llm)
+            return await self.generators[model_name].generate(request_payload)
+        finally:
+            self.model_manager.release(model_name, time.perf_counter() - start)
@@ -0,0 +1,85 @@
+import importlib.util
+import math
+import threading
+
+from loguru import logger
+
+from app.util import ModelConfig
+
+
+def get_kv_bytes_per_token(model_config, element_size: int) -> int:
+    layers = getattr(model_config, 'num_hidden_layers', None) or getattr(model_config, 'n_layer')
+    hidden_size = getattr(model_config, 'hidden_size', None) or getattr(model_config, 'n_embd')
+    heads = getattr(model_config, 'num_attention_heads', None) or getattr(model_config, 'n_head')
+    kv_heads = getattr(model_config, 'num_key_value_heads', None) or getattr(model_config, 'num_kv_heads', None)
+    if kv_heads is None:
+        kv_heads = 1 if getattr(model_config, 'multi_query', False) else heads
+    # keys and values for every layer
+    return 2 * layers * kv_heads * (hidden_size // heads) * element_size
+
+
+def get_quantized_cache_config(kv_cache_dtype: str) -> dict:
+    if kv_cache_dtype != 'int8':
+        return {}
+    # QuantizedCacheConfig is gone in transformers 5, the cache itself and the generate arguments remain
+    try:
+        from transformers import QuantizedCache  # noqa: F401
+    except ImportError:
+        logger.warning("int8 KV cache needs transformers>=4.42, falling back to full precision")
+        return {}
+    if importlib.util.find_spec('hqq') is None:
+        logger.warning("int8 KV cache needs the hqq package, falling back to full precision")
+        return {}
+    return {'cache_implementation': 'quantized', 'cache_config': {'backend': 'HQQ', 'nbits': 8}}
+
+
+class KvCacheManager:
+    def __init__(self, budget_bytes: int, block_size: int = 16):
+        self.budget_bytes = budget_bytes
+        self.block_size = block_size
+        self.reserved_bytes = 0
+        self.peak_reserved_bytes = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: ModelConfig) -> 'KvCacheManager | None':
+        if config.kv_cache_budget <= 0:
+            return None
+        return cls(int(config.kv_cache_budget * 1024 ** 3), config.kv_block_size)
+
+    def get_blocks(self, tokens: int) -> int:
+        return math.ceil(tokens / self.block_size)
+
+    def get_reservation_bytes(self, tokens: int, bytes_per_token: int) -> int:
+        return self.get_blocks(tokens) * self.block_size * bytes_per_token
+
+    def get_max_tokens(self, bytes_per_token: int) -> int | None:
+        if self.budget_bytes <= 0:
+            return None
+        return self.budget_bytes // (self.block_size * bytes_per_token) * self.block_size
+
+    def reserve(self, tokens: int, bytes_per_token: int) -> int | None:
+        # returns the reserved bytes, or None if the budget is in use; this never waits, because generation runs on the
+        # event loop, where waiting for another request's blocks would stall every request
+        reservation = self.get_reservation_bytes(tokens, bytes_per_token)
+        with self._lock:
+            if self.budget_bytes > 0 and self.reserved_bytes + reservation > self.budget_bytes:
+                self.rejected += 1
+                return None
+            self.reserved_bytes += reservation
+            self.peak_reserved_bytes = max(self.peak_reserved_bytes, self.reserved_bytes)
+            self.admitted += 1
+        return reservation
+
+    def release(self, reservation: int):
+        with self._lock:
+            self.reserved_bytes -= reservation
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'budget_gb': round(self.budget_bytes / 1024 ** 3, 3),
+                    'reserved_gb': round(self.reserved_bytes / 1024 ** 3, 3),
+                    'peak_reserved_gb': round(self.peak_reserved_bytes / 1024 ** 3, 3),
+                    'block_size': self.block_size, 'admitted': self.admitted, 'rejected': self.rejected}
@@ -6,14 +6,21 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from loguru import logger
 
-from app.Llm import Llm
-from app.generators import CodeGenerator, ChatGenerator
+from app.embeddings import Embedder
+from app.gateway import Gateway
+from app.generators import CodeGenerator, ChatGenerator, ModelRoutingGenerator
 from app.logger import configure_logger
-from app.request_handler import RequestHandler
+from app.model_manager import ModelManager
+from app.request_handler import RequestHandler, SemanticResponseCache
 from app.request_handler import RequestHandlerProvider
 from app.model.api_models import CompletionType
 from app.routers.completion import get_completion_router
+from app.routers.embeddings import get_embeddings_router
 from app.routers.feedback import get_feedback_router
+from app.routers.health import get_health_router
+from app.routers.gateway import get_gateway_router, get_gateway_polling_router
+from app.routers.status import get_status_router
+from app.startup import StartupMonitor
 from app.util import get_config_from_arguments, ApiConfig, ModelConfig
 
 
@@ -21,16 +28,53 @@ def read_version():
     return (Path(__file__).parent.parent / "VERSION").read_text().strip()
 
 
-def add_completion_endpoints(model_config: ModelConfig, router: APIRouter):
-    llm = Llm(model_config)
+def add_completion_endpoints(model_config: ModelConfig, router: APIRouter, startup_monitor: StartupMonitor,
+                             trusted_proxies: list[str]) -> dict:
+    model_manager = ModelManager(model_config)
+    status_sources = {'models': model_manager.status}
+    if model_manager.kv_cache_manager is not None:
+        status_sources['kv_cache'] = model_manager.kv_cache_manager.status
+    embedder, semantic_cache = None, None
+    if model_config.semantic_cache or model_config.embeddings_endpoint:
+        # the embeddings endpoint and the semantic cache share one encoder
+        embedder = Embedder(model_config.embedding_model, model_config.embedding_device,
+                            model_config.embedding_max_length or None)
+    if model_config.embeddings_endpoint:
+        router.include_router(get_embeddings_router(embedder, model_config.embedding_batch_size))
+    if model_config.semantic_cache:
+        semantic_cache = SemanticResponseCache(embedder, model_config.semantic_cache_threshold,
+                                               model_config.semantic_cache_size, model_manager.resolve)
+        status_sources['semantic_cache'] = semantic_cache.status
+
+    def load_models():
+        model_manager.preload()
+        if embedder is not None:
+            embedder.load()
+
+    # the port opens right away; requests arriving before the default model is loaded wait for it
+    startup_monitor.run_in_background('load_default_model', load_models)
     generator_classes = {
         CompletionType.CODE: CodeGenerator, 
         CompletionType.CHAT: ChatGenerator
     }
+    request_handlers = []
     for api_type, generator_class in generator_classes.items():
-        generator = generator_class(llm)
-        request_handler = RequestHandler(generator=generator)
+        generator = ModelRoutingGenerator(generator_class, model_manager)
+        request_handler = RequestHandler(generator=generator, concurrency=model_config.replicas,
+                                         semantic_cache=semantic_cache if api_type == CompletionType.CHAT else None,
+                                         trusted_proxies=frozenset(trusted_proxies))
         router.include_router(get_completion_router(api_type, RequestHandlerProvider(request_handler)))
+        request_handlers.append(request_handler)
+    status_sources['queue_depth'] = lambda: sum(handler.queue_depth() for handler in request_handlers)
+    return status_sources
+
+
+def add_gateway_endpoints(api_config: ApiConfig, router: APIRouter) -> Gateway:
+    gateway = Gateway(api_config.gateway_backends, api_config.auth_prefix)
+    for api_type in CompletionType:
+        router.include_router(get_gateway_router(api_type, gateway))
+    router.include_router(get_gateway_polling_router(gateway))
+    return gateway
 
 
 def add_feedback_endpoint(router):
@@ -44,8 +88,7 @@ def build_app(api_config: ApiConfig, model_config: ModelConfig) -> FastAPI:
 
     app: FastAPI = FastAPI(
         title="TNG Internal LLM Server",
-        version=read_version(),
-        dependencies=[Depends(verify_token)]
+        version=read_version()
     )
 
     app.add_middleware(CORSMiddleware,
@@ -54,10 +97,23 @@ def build_app(api_config: ApiConfig, model_config: ModelConfig) -> FastAPI:
             allow_methods=["*"],
             allow_headers=["*"])
 
-    router = APIRouter()
-    add_completion_endpoints(model_config, router)
-    add_feedback_endpoint(router)
-    app.include_router(router)
+    startup_monitor = StartupMonitor()
+    with startup_monitor.phase('build_app'):
+        router = APIRouter(dependencies=[Depends(verify_token)])
+        if api_config.gateway_backends:
+            gateway = add_gateway_endpoints(api_config, router)
+            status_sources = {'queue_depth': lambda: sum(backend.load() for backend in gateway.backends),
+                              'backends': gateway.status}
+            startup_monitor.set_ready()
+        else:
+            status_sources = add_completion_endpoints(model_config, router, startup_monitor,
+                                                      api_config.trusted_proxies)
+        status_sources['startup'] = startup_monitor.status
+        router.include_router(get_status_router(status_sources))
+        add_feedback_endpoint(router)
+        app.include_router(router)
+        # liveness and readiness probes of load balancers and orchestrators carry no bearer token
+        app.include_router(get_health_router(startup_monitor))
 
     return app
 
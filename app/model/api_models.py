@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Literal
 
 from pydantic import BaseModel
 
@@ -88,6 +88,19 @@ class ChatCompletionRequestPayload(CompletionRequestPayload):
         return hash((self.model, self.max_tokens, "\n".join([f"{role}{name}: {content}" for role, content, name in self.messages]), self.max_tokens, self.user))
 
 
+class EmbeddingRequestPayload(RequestPayload):
+    input: str | List[str]
+    model: str
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    user: Optional[str] = None
+
+    def key(self):
+        return self.model, self.encoding_format, tuple(self.inputs())
+
+    def inputs(self) -> List[str]:
+        return [self.input] if isinstance(self.input, str) else self.input
+
+
 class CompletionApiChoice(BaseModel):
     text: str
     index: int
@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict, defaultdict
+from timeit import default_timer as timer
+
+from loguru import logger
+
+from app.Llm import Llm
+from app.kv_cache import KvCacheManager
+from app.replica_pool import LlmReplicaPool
+from app.util import ModelConfig
+
+
+class ModelStats:
+    def __init__(self):
+        self.state = 'unloaded'
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.warmup_time = 0.0
+        self.memory_footprint = 0
+        self.requests = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record_latency(self, latency: float):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def to_dict(self) -> dict:
+        return {'state': self.state, 'loads': self.loads, 'evictions': self.evictions,
+                'load_time': round(self.load_time, 3), 'warmup_time': round(self.warmup_time, 3),
+                'memory_gb': round(self.memory_footprint / 1024 ** 3, 3),
+                'requests': self.requests, 'max_latency': round(self.max_latency, 3),
+                'mean_latency': round(self.total_latency / self.requests, 3) if self.requests else 0.0}
+
+
+class ModelManager:
+    def __init__(self, config: ModelConfig):
+        self.config = config
+        self.default_model = config.model_name
+        self.max_resident_models = max(1, config.max_resident_models)
+        self.memory_budget = int(config.model_memory_budget * 1024 ** 3)
+        if self.memory_budget > 0 and config.replicas > 1:
+            logger.warning("--model-memory-budget is ignored with --replicas, the replicas' memory is not measured")
+            self.memory_budget = 0
+        # only these models can be requested by clients, everything else is served by the default model
+        self.allowed_models = {config.model_name, *config.models}
+        for model_name in self.allowed_models:
+            assert model_name in Llm.models, f"model {model_name} not found.\nchose one of: {[key for key in Llm.models.keys()]}"
+        self.offload_to_cpu = config.offload_evicted_models
+        self.llms: dict[str, Llm | LlmReplicaPool] = {}
+        self.resident: OrderedDict[str, None] = OrderedDict()
+        self.in_use: dict[str, int] = defaultdict(int)
+        self.stats: dict[str, ModelStats] = defaultdict(ModelStats)
+        # one KV cache budget is shared by all models of this process; replicas account for their own share
+        self.kv_cache_manager: KvCacheManager | None = KvCacheManager.from_config(config) \
+            if config.replicas <= 1 else None
+        self._lock: threading.Lock = threading.Lock()
+        self._load_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    def resolve(self, requested_model: str | None) -> str:
+        for model_name in self.allowed_models:
+            model_config = Llm.models[model_name]
+            if requested_model in (model_name, model_config['model']) and model_config.get('task') != 'embedding':
+                return model_name
+        return self.default_model
+
+    def create_llm(self, model_name: str) -> Llm | LlmReplicaPool:
+        # the tokenizer is loaded once per model and stays around when the weights are evicted
+        config = self.config.model_copy(update={'model_name': model_name, 'do_not_load_llm': True})
+        if config.replicas > 1:
+            return LlmReplicaPool(config)
+        llm = Llm(config)
+        llm.kv_cache_manager = self.kv_cache_manager
+        return llm
+
+    def acquire(self, model_name: str) -> Llm | LlmReplicaPool:
+        with self._lock:
+            load_lock = self._load_locks[model_name]
+        with load_lock:
+            with self._lock:
+                self.in_use[model_name] += 1
+                if model_name in self.resident:
+                    self.resident.move_to_end(model_name)
+                    return self.llms[model_name]
+                victims = self.select_victims(self.max_resident_models - 1,
+                                              self.memory_budget - self.stats[model_name].memory_footprint)
+            self.evict(victims)
+            try:
+                self.load(model_name)
+            except BaseException:
+                with self._lock:
+                    self.in_use[model_name] -= 1
+                raise
+            with self._lock:
+                self.resident[model_name] = None
+                victims = self.select_victims(self.max_resident_models, self.memory_budget)
+            self.evict(victims)
+            return self.llms[model_name]
+
+    def release(self, model_name: str, latency: float | None = None):
+        with self._lock:
+            self.in_use[model_name] -= 1
+            if latency is not None:
+                self.stats[model_name].record_latency(latency)
+
+    def load(self, model_name: str):
+        stats = self.stats[model_name]
+        start = timer()
+        if model_name not in self.llms:
+            self.llms[model_name] = self.create_llm(model_name)
+        llm = self.llms[model_name]
+        if not self.config.do_not_load_llm:
+            llm.load_model(self.config.bitsize)
+        stats.load_time = timer() - start
+        stats.loads += 1
+        stats.state = 'resident'
+        stats.memory_footprint = llm.memory_footprint()
+        stats.warmup_time = getattr(llm, 'warmup_time', 0.0)
+        logger.info(f"loaded model {model_name} in {stats.load_time:.2f}s "
+                    f"({stats.memory_footprint / 1024 ** 3:.2f} GB)")
+
+    def resident_memory(self) -> int:
+        return sum(self.stats[model_name].memory_footprint for model_name in self.resident)
+
+    def select_victims(self, max_models: int, memory_budget: int) -> list[str]:
+        # called with self._lock held; models serving a request are never evicted
+        victims = []
+        for model_name in list(self.resident):
+            over_memory = self.memory_budget > 0 and self.resident_memory() > memory_budget
+            if len(self.resident) <= max_models and not over_memory:
+                break
+            if self.in_use[model_name] > 0:
+                continue
+            del self.resident[model_name]
+            self.stats[model_name].state = 'evicting'
+            victims.append(model_name)
+        return victims
+
+    def evict(self, victims: list[str]):
+        # unloading can take seconds, so it runs outside self._lock under the model's own load lock
+        for model_name in victims:
+            with self._load_locks[model_name]:
+                with self._lock:
+                    if model_name in self.resident:
+                        continue
+                llm = self.llms[model_name]
+                llm.unload_model(self.offload_to_cpu)
+                with self._lock:
+                    stats = self.stats[model_name]
+                    stats.evictions += 1
+                    stats.state = 'offloaded' if getattr(llm, 'offload_device', None) is not None else 'unloaded'
+                    logger.info(f"evicted model {model_name} ({stats.state}), {len(self.resident)} models with "
+                                f"{self.resident_memory() / 1024 ** 3:.2f} GB resident")
+
+    def preload(self, model_name: str | None = None):
+        model_name = model_name or self.default_model
+        self.acquire(model_name)
+        self.release(model_name)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {model_name: stats.to_dict() for model_name, stats in self.stats.items()}
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import threading
+from array import array
+from multiprocessing.connection import Connection
+
+from loguru import logger
+
+from app.Llm import Llm
+from app.util import ModelConfig
+
+_TOKEN_ID_TYPECODE = 'q'
+
+
+def send_message(conn: Connection, header: dict, token_ids: list | array = ()):
+    # the header is a small json document, token ids travel as a raw int64 buffer
+    conn.send_bytes(json.dumps(header).encode())
+    conn.send_bytes(array(_TOKEN_ID_TYPECODE, token_ids).tobytes())
+
+
+def recv_message(conn: Connection) -> tuple[dict, array]:
+    header = json.loads(conn.recv_bytes())
+    token_ids = array(_TOKEN_ID_TYPECODE)
+    token_ids.frombytes(conn.recv_bytes())
+    return header, token_ids
+
+
+def split_cores(replicas: int, cores_per_replica: int = 0) -> list[list[int]]:
+    available = sorted(os.sched_getaffinity(0))
+    if cores_per_replica <= 0:
+        cores_per_replica = max(1, len(available) // replicas)
+    if cores_per_replica * replicas > len(available):
+        logger.warning(f"{replicas} replicas with {cores_per_replica} cores each exceed the {len(available)} "
+                       f"available cores, replicas will share cores")
+        return [[available[(i * cores_per_replica + j) % len(available)] for j in range(cores_per_replica)]
+                for i in range(replicas)]
+    return [available[i * cores_per_replica:(i + 1) * cores_per_replica] for i in range(replicas)]
+
+
+def _replica_main(conn: Connection, model_config: dict, cores: list[int]):
+    os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    import torch
+    torch.set_num_threads(len(cores))
+
+    llm = Llm(ModelConfig.model_validate(model_config))
+    send_message(conn, {'type': 'ready'})
+    while True:
+        try:
+            header, token_ids = recv_message(conn)
+        except (EOFError, OSError):
+            break
+        if header['type'] == 'shutdown':
+            break
+        if header['type'] == 'ping':
+            send_message(conn, {'type': 'pong'})
+            continue
+        try:
+            output_ids, prompt_tokens, completion_tokens = llm.generate_from_token_ids(
+                token_ids.tolist(), header['generation_config'], header['stop_ids'],
+                header['remove_prompt_from_reply'])
+            send_message(conn, {'type': 'result', 'prompt_tokens': prompt_tokens,
+                                'completion_tokens': completion_tokens}, output_ids)
+        except (RuntimeError, AttributeError, ValueError) as e:
+            send_message(conn, {'type': 'error', 'message': str(e)})
+    conn.close()
+
+
+class LlmReplica:
+    def __init__(self, index: int, model_config: dict, cores: list[int]):
+        self.index = index
+        self.model_config = model_config
+        self.cores = cores
+        self.lock: threading.Lock = threading.Lock()
+        self.in_flight = 0
+        self.healthy = False
+        self.conn: Connection | None = None
+        self.process = None
+        self.start()
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_replica_main, args=(child_conn, self.model_config, self.cores),
+                                   name=f"llm-replica-{self.index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.healthy = False
+        logger.info(f"started replica {self.index} (pid {self.process.pid}) on cores {self.cores}")
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        try:
+            if self.conn.poll(timeout):
+                header, _ = recv_message(self.conn)
+                self.healthy = header['type'] == 'ready'
+        except (EOFError, OSError):
+            self.healthy = False
+        return self.healthy
+
+    def request(self, header: dict, token_ids: list | array = (), timeout: float | None = None) -> tuple[dict, array]:
+        with self.lock:
+            return self._request(header, token_ids, timeout)
+
+    def _request(self, header: dict, token_ids: list | array = (), timeout: float | None = None) -> tuple[dict, array]:
+        # callers must hold self.lock
+        try:
+            send_message(self.conn, header, token_ids)
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"replica {self.index} did not answer within {timeout}s")
+            return recv_message(self.conn)
+        except (EOFError, OSError, TimeoutError) as e:
+            self.healthy = False
+            raise RuntimeError(f"replica {self.index} failed: {e}") from e
+
+    def check_health(self, timeout: float) -> bool:
+        if not self.process.is_alive():
+            self.healthy = False
+        elif self.healthy and self.lock.acquire(blocking=False):
+            # busy replicas are answering requests, so only idle ones get pinged, while still holding the lock
+            try:
+                self.healthy = self._request({'type': 'ping'}, timeout=timeout)[0]['type'] == 'pong'
+            except RuntimeError:
+                self.healthy = False
+            finally:
+                self.lock.release()
+        return self.healthy
+
+    def restart(self, timeout: float | None = None):
+        logger.warning(f"restarting unhealthy replica {self.index}")
+        with self.lock:
+            self.stop()
+            self.start()
+            self.wait_ready(timeout)
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                send_message(self.conn, {'type': 'shutdown'})
+            except OSError:
+                pass
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.conn.close()
+
+
+class LlmReplicaPool:
+    health_check_interval = 10.0
+    health_check_timeout = 5.0
+    load_timeout = 600.0
+
+    def __init__(self, config: ModelConfig):
+        self.config = config
+        # the parent only needs the tokenizer: prompts are encoded here and token ids are sent to the replicas
+        self.llm = Llm(config.model_copy(update={'device': 'cpu', 'do_not_load_llm': True}))
+        self.model_name = self.llm.model_name
+        self.tokenizer = self.llm.tokenizer
+        self.stop_ids: list = []
+        self.lock: threading.Lock = threading.Lock()
+        self.replicas: list[LlmReplica] = []
+        self._closed = threading.Event()
+        if not config.do_not_load_llm:
+            self.load_model(config.bitsize)
+
+    def load_model(self, bitsize: int):
+        if self.replicas:
+            return
+        # every replica gets an equal share of the KV cache budget
+        child_config = self.config.model_copy(update={'device': self.config.device or 'cpu', 'replicas': 1,
+                                                      'bitsize': bitsize, 'do_not_load_llm': False,
+                                                      'kv_cache_budget': self.config.kv_cache_budget / self.config.replicas})
+        self.llm.timeit()
+        replicas = [LlmReplica(index, child_config.model_dump(by_alias=True), cores)
+                    for index, cores in enumerate(split_cores(self.config.replicas, self.config.cores_per_replica))]
+        for replica in replicas:
+            if not replica.wait_ready(self.load_timeout):
+                logger.error(f"replica {replica.index} failed to start")
+        self.llm.timeit(f"start {len(replicas)} replicas")
+        self.replicas = replicas
+        self._closed = threading.Event()
+        threading.Thread(target=self.run_health_checks, args=(self._closed,), name="llm-replica-health",
+                         daemon=True).start()
+
+    def unload_model(self, offload_to_cpu: bool = False):
+        # replicas live in their own processes, so there is nothing to offload into this one
+        self.close()
+
+    def memory_footprint(self) -> int:
+        return 0
+
+    def add_stopwords(self, stop_word_list):
+        self.stop_ids = [self.tokenizer.encode(w)[0] for w in stop_word_list]
+
+    def get_stopping_criteria_list(self, stop_word_list):
+        return self.llm.get_stopping_criteria_list(stop_word_list)
+
+    def acquire_replica(self) -> LlmReplica:
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica.healthy]
+            if not candidates:
+                raise RuntimeError("no healthy model replica available")
+            replica = min(candidates, key=lambda r: r.in_flight)
+            replica.in_flight += 1
+        return replica
+
+    def release_replica(self, replica: LlmReplica):
+        with self.lock:
+            replica.in_flight -= 1
+
+    def generate(self, prompt: str, generation_config: dict, stopping_criteria_list=None,
+                 remove_prompt_from_reply: bool = True) -> tuple:
+        if not self.replicas:
+            return "Testing without LLM", 0, 0
+        token_ids = self.tokenizer(prompt, return_token_type_ids=False)['input_ids']
+        stop_ids = self.stop_ids
+        if stopping_criteria_list is not None:
+            stop_ids = [i for criteria in stopping_criteria_list for i in getattr(criteria, 'keywords_ids', [])]
+        header = {'type': 'generate', 'generation_config': generation_config, 'stop_ids': stop_ids,
+                  'remove_prompt_from_reply': True}
+        # a replica that dies mid-request is marked unhealthy, so the retry goes to another one
+        for attempt in range(2):
+            replica = self.acquire_replica()
+            try:
+                response, output_ids = replica.request(header, token_ids)
+                break
+            except RuntimeError as e:
+                if attempt == 1:
+                    raise
+                logger.warning(f"{e}, retrying on another replica")
+            finally:
+                self.release_replica(replica)
+        if response['type'] == 'error':
+            raise RuntimeError(f"replica {replica.index}: {response['message']}")
+        answer = self.tokenizer.decode(output_ids.tolist())
+        if not remove_prompt_from_reply:
+            answer = prompt + answer
+        return answer, response['prompt_tokens'], response['completion_tokens']
+
+    async def generate_async(self, prompt: str, generation_config: dict, stopping_criteria_list=None,
+                             remove_prompt_from_reply: bool = True) -> tuple:
+        return await asyncio.to_thread(self.generate, prompt, generation_config, stopping_criteria_list,
+                                       remove_prompt_from_reply)
+
+    def run_health_checks(self, closed: threading.Event):
+        replicas = self.replicas
+        while not closed.wait(self.health_check_interval):
+            for replica in replicas:
+                if not replica.check_health(self.health_check_timeout) and not closed.is_set():
+                    # a replica hanging while it loads must not block the checks of all the others
+                    replica.restart(self.load_timeout)
+
+    def health(self) -> list[dict]:
+        return [{'replica': r.index, 'pid': r.process.pid, 'cores': r.cores, 'healthy': r.healthy,
+                 'in_flight': r.in_flight} for r in self.replicas]
+
+    def get_timing(self):
+        return self.llm.get_timing()
+
+    def close(self):
+        self._closed.set()
+        replicas, self.replicas = self.replicas, []
+        for replica in replicas:
+            replica.stop()
@@ -1,19 +1,22 @@
 import asyncio
 import threading
 import time
-from collections import deque
+from collections import deque, OrderedDict
+from typing import Callable
 
 from fastapi import Request
 from pydantic import BaseModel
 
 from loguru import logger
+from app.embeddings import Embedder
 from app.model.api_models import GeneratorBase, GeneratorException, ApiResponse, RequestPayload
 
 
 class ClientRequest:
-    def __init__(self, request: Request, request_payload: RequestPayload, cnt: int):
+    def __init__(self, request: Request, request_payload: RequestPayload, cnt: int,
+                 trusted_proxies: frozenset[str] = frozenset()):
         self.creation_time = time.time()
-        self.id: str = self.get_client_id(request)
+        self.id: str = self.get_client_id(request, trusted_proxies)
         self.cnt: int = cnt
         self.request: Request = request
         self.request_payload = request_payload
@@ -21,14 +24,22 @@ class ClientRequest:
         self.event: asyncio.Event = asyncio.Event()
 
     @staticmethod
-    def get_client_id(request):
+    def get_client_id(request, trusted_proxies: frozenset[str] = frozenset()):
         if 'authorization' in request._headers:
             auth_header = request._headers['authorization']
             logger.debug(f"auth_header {auth_header}")
             if auth_header.startswith("Bearer "):
-                return auth_header[7:] + request.client.host
+                return auth_header[7:] + ClientRequest.get_client_host(request, trusted_proxies)
         return ""
 
+    @staticmethod
+    def get_client_host(request, trusted_proxies: frozenset[str] = frozenset()):
+        # behind a gateway the connecting host is the gateway, which passes the original host along;
+        # the header is only believed from trusted gateways, otherwise clients could pick their own client id
+        if request.client.host in trusted_proxies and 'x-forwarded-for' in request._headers:
+            return request._headers['x-forwarded-for'].split(",")[0].strip()
+        return request.client.host
+
 
 class ClientRequestQueue:
     def __init__(self):
@@ -48,6 +59,9 @@ class ClientRequestQueue:
             self._client_items[client_id] = item
         return exchanged_item
 
+    def __len__(self) -> int:
+        return len(self._queue)
+
     async def get(self) -> ClientRequest:
         while True:
             with self._lock:
@@ -76,12 +90,145 @@ class ResponseCache:
         return None
 
 
+class SemanticIndex:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.embeddings = None
+        self.contexts = None
+        self.responses: list[ApiResponse | None] = [None] * max_entries
+        self.size = 0
+        self.next = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def add(self, embedding, api_response: ApiResponse, context: int):
+        import torch
+        with self._lock:
+            if self.embeddings is None:
+                self.embeddings = torch.zeros((self.max_entries, embedding.shape[-1]), dtype=embedding.dtype)
+                self.contexts = torch.zeros(self.max_entries, dtype=torch.int64)
+            # a ring buffer: once full, the oldest answer is overwritten
+            self.embeddings[self.next] = embedding
+            self.contexts[self.next] = context
+            self.responses[self.next] = api_response
+            self.next = (self.next + 1) % self.max_entries
+            self.size = min(self.size + 1, self.max_entries)
+
+    def search(self, embedding, context: int) -> tuple[float, ApiResponse | None]:
+        # only answers given in the same conversation context and with the same parameters can be reused
+        with self._lock:
+            if self.size == 0:
+                return 0.0, None
+            scores = (self.embeddings[:self.size] @ embedding).masked_fill(self.contexts[:self.size] != context,
+                                                                           float('-inf'))
+            score, best = scores.max(0)
+            if score.isinf():
+                return 0.0, None
+            return float(score), self.responses[int(best)]
+
+
+class SemanticResponseCache:
+    max_query_tokens = 128
+    max_memoized_queries = 1024
+
+    def __init__(self, embedder: Embedder, threshold: float, max_entries: int,
+                 resolve_model: Callable[[str | None], str]):
+        self.embedder = embedder
+        self.resolve_model = resolve_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._indexes: dict[str, SemanticIndex] = dict()
+        self._query_embeddings: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+
+    def get_query(self, request_payload: RequestPayload) -> tuple[str, int, str] | None:
+        messages = getattr(request_payload, 'messages', [])
+        if not messages or messages[-1].role != 'user':
+            return None
+        # the last user message is matched by meaning, everything else that shapes the answer must match exactly
+        context = hash((request_payload.user, request_payload.max_tokens,
+                        tuple((message.role, message.name, message.content) for message in messages[:-1])))
+        return self.resolve_model(request_payload.model), context, messages[-1].content.strip().lower()
+
+    def embed(self, query: str):
+        # a query is embedded for the lookup and again for the update after generation, so keep recent ones
+        with self._lock:
+            if query in self._query_embeddings:
+                self._query_embeddings.move_to_end(query)
+                return self._query_embeddings[query]
+        embedding = self.embedder.embed([query], max_length=self.max_query_tokens)[0]
+        with self._lock:
+            self._query_embeddings[query] = embedding
+            if len(self._query_embeddings) > self.max_memoized_queries:
+                self._query_embeddings.popitem(last=False)
+        return embedding
+
+    def _retrieve(self, request_payload: RequestPayload) -> ApiResponse | None:
+        query = self.get_query(request_payload)
+        if query is None:
+            return None
+        start = time.perf_counter()
+        model, context, text = query
+        embedding = self.embed(text)
+        # the cache-wide lock only guards the bookkeeping, every index has its own lock for the search
+        with self._lock:
+            index = self._indexes.get(model)
+        score, api_response = index.search(embedding, context) if index is not None else (0.0, None)
+        with self._lock:
+            self.lookup_time += time.perf_counter() - start
+            if api_response is None or score < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.debug(f"semantic cache hit with similarity {score:.3f}")
+        api_response = api_response.model_copy()
+        api_response.set_is_cached_response()
+        return api_response
+
+    def _update(self, request_payload: RequestPayload, api_response: ApiResponse):
+        query = self.get_query(request_payload)
+        # only successful answers are cached, error responses carry no choices
+        if query is None or not getattr(api_response, 'choices', None):
+            return
+        model, context, text = query
+        embedding = self.embed(text)
+        with self._lock:
+            if model not in self._indexes:
+                self._indexes[model] = SemanticIndex(self.max_entries)
+            index = self._indexes[model]
+        index.add(embedding, api_response, context)
+
+    async def retrieve(self, request_payload: RequestPayload) -> ApiResponse | None:
+        return await asyncio.to_thread(self._retrieve, request_payload)
+
+    async def update(self, request_payload: RequestPayload, api_response: ApiResponse):
+        await asyncio.to_thread(self._update, request_payload, api_response)
+
+    def status(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                    'mean_lookup_ms': round(1000 * self.lookup_time / lookups, 3) if lookups else 0.0,
+                    'entries': {model: index.size for model, index in self._indexes.items()}}
+
+
 class RequestHandler:
-    def __init__(self, generator: GeneratorBase):
+    def __init__(self, generator: GeneratorBase, concurrency: int = 1,
+                 semantic_cache: SemanticResponseCache | None = None, trusted_proxies: frozenset[str] = frozenset()):
         self.generator: GeneratorBase = generator
+        self.concurrency: int = concurrency
         self.queue: ClientRequestQueue = ClientRequestQueue()
         self.response_cache: ResponseCache = ResponseCache()
+        self.semantic_cache: SemanticResponseCache | None = semantic_cache
+        self.trusted_proxies: frozenset[str] = trusted_proxies
         self.cnt = 0
+        self.in_progress = 0
+
+    def queue_depth(self) -> int:
+        return len(self.queue) + self.in_progress
 
     async def process_request_queue(self):
         while True:
@@ -91,16 +238,21 @@ class RequestHandler:
             request_payload = client_request.request_payload
             logger.debug(f"got request {client_request.cnt} from queue {request.client.port}")
             api_response: ApiResponse = await self.response_cache.retrieve(request_payload)
+            self.in_progress += 1
             try:
                 if api_response is None:
                     await asyncio.sleep(0.005)
                     api_response = await self.generator.generate(request_payload)
                     await self.response_cache.update(request_payload, api_response)
+                    if self.semantic_cache is not None:
+                        await self.semantic_cache.update(request_payload, api_response)
                 else:
                     logger.debug(f"cache hit for request {client_request.cnt}")
             except GeneratorException as e:
                 # pass the error message as generated text, so that the user will see it within the IDE
                 api_response = self.generator.generate_default_api_response(str(e), 400)
+            finally:
+                self.in_progress -= 1
             logger.debug(f"done processing request {client_request.cnt} from queue {request.client.port}")
             client_request.api_response = api_response
             client_request.event.set()
@@ -109,9 +261,11 @@ class RequestHandler:
         self.cnt += 1
         local_cnt = self.cnt
         logger.info(f" received request {local_cnt} from {request.client.host}:{request.client.port}")
-        client_request: ClientRequest = ClientRequest(request, request_payload, local_cnt)
+        client_request: ClientRequest = ClientRequest(request, request_payload, local_cnt, self.trusted_proxies)
 
         cached_response = await self.response_cache.retrieve(request_payload)
+        if cached_response is None and self.semantic_cache is not None:
+            cached_response = await self.semantic_cache.retrieve(request_payload)
         if cached_response is not None:
             logger.debug(f"cache hit for request {local_cnt}")
             logger.info(
@@ -35,6 +35,8 @@ def get_completion_router(api_type: CompletionType, request_handler_provider: Re
 
     @router.on_event("startup")
     async def on_startup():
-        asyncio.create_task(request_handler_provider.get_handler().process_request_queue())
+        request_handler = request_handler_provider.get_handler()
+        for _ in range(request_handler.concurrency):
+            asyncio.create_task(request_handler.process_request_queue())
 
     return router
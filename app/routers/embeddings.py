@@ -0,0 +1,51 @@
+import asyncio
+import base64
+import json
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from loguru import logger
+
+from app.embeddings import Embedder
+from app.model.api_models import EmbeddingRequestPayload
+
+
+def encode_embeddings(embeddings, encoding_format: str, chunk_size: int = 64):
+    # the response is streamed in chunks, so large input lists never exist as one big json document in memory
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = embeddings[start:start + chunk_size]
+        if encoding_format == "base64":
+            values = [json.dumps(base64.b64encode(row.numpy().tobytes()).decode()) for row in chunk]
+        else:
+            values = [json.dumps(row) for row in chunk.tolist()]
+        yield ",".join(f'{{"object":"embedding","index":{start + i},"embedding":{value}}}'
+                       for i, value in enumerate(values)) + ("," if start + chunk_size < len(embeddings) else "")
+
+
+def get_embeddings_router(embedder: Embedder, batch_size: int, max_inputs: int = 2048) -> APIRouter:
+    router = APIRouter(
+        prefix="/v1/embeddings", tags=["embeddings"]
+    )
+
+    @router.post("/")
+    async def create_embeddings(request_payload: EmbeddingRequestPayload) -> StreamingResponse:
+        inputs = request_payload.inputs()
+        if not inputs or len(inputs) > max_inputs:
+            raise HTTPException(status_code=400, detail=f"input must contain between 1 and {max_inputs} items")
+        if request_payload.model != embedder.model_name:
+            logger.debug(f"embedding model {request_payload.model} requested, using {embedder.model_name}")
+        embeddings, prompt_tokens, truncated = await asyncio.to_thread(embedder.embed_batched, inputs, batch_size)
+        if truncated:
+            logger.warning(f"{truncated} of {len(inputs)} embedding inputs were truncated "
+                           f"to {embedder.max_length} tokens")
+
+        def stream():
+            yield '{"object":"list","data":['
+            yield from encode_embeddings(embeddings, request_payload.encoding_format)
+            yield f'],"model":{json.dumps(embedder.model_name)},' \
+                  f'"usage":{{"prompt_tokens":{prompt_tokens},"total_tokens":{prompt_tokens}}}}}'
+
+        return StreamingResponse(stream(), media_type="application/json",
+                                 headers={'x-truncated-inputs': str(truncated)})
+
+    return router
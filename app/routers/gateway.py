@@ -0,0 +1,38 @@
+import asyncio
+
+from fastapi import APIRouter, Request, Response, HTTPException
+
+from app.gateway import Gateway, GatewayException
+from app.model.api_models import CompletionType
+from app.request_handler import ClientRequest
+from app.routers.completion import _API_TYPE_CONVENTION_TO_MODEL_OPENAI
+
+
+def get_gateway_router(api_type: CompletionType, gateway: Gateway) -> APIRouter:
+    router = APIRouter(
+        prefix=_API_TYPE_CONVENTION_TO_MODEL_OPENAI[api_type], tags=[api_type]
+    )
+
+    @router.post("/")
+    async def forward_completion(request: Request) -> Response:
+        body = await request.body()
+        try:
+            # the gateway faces the clients, so their own x-forwarded-for headers are never trusted here
+            status, content_type, content = await gateway.forward_async(ClientRequest.get_client_id(request),
+                                                                        request.client.host, request.url.path, body,
+                                                                        dict(request.headers))
+        except GatewayException as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        return Response(content=content, status_code=status, media_type=content_type)
+
+    return router
+
+
+def get_gateway_polling_router(gateway: Gateway) -> APIRouter:
+    router = APIRouter()
+
+    @router.on_event("startup")
+    async def on_startup():
+        asyncio.create_task(gateway.poll_backends())
+
+    return router
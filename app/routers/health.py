@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from app.startup import StartupMonitor
+
+
+def get_health_router(startup_monitor: StartupMonitor) -> APIRouter:
+    router = APIRouter(tags=["health"])
+
+    @router.get("/health")
+    def get_health() -> dict:
+        return startup_monitor.status()
+
+    @router.get("/ready")
+    def get_ready() -> JSONResponse:
+        status_code = 200 if startup_monitor.ready.is_set() else 503
+        return JSONResponse(content=startup_monitor.status(), status_code=status_code)
+
+    return router
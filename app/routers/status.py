@@ -0,0 +1,15 @@
+from typing import Any, Callable
+
+from fastapi import APIRouter
+
+
+def get_status_router(status_sources: dict[str, Callable[[], Any]]) -> APIRouter:
+    router = APIRouter(
+        prefix="/status", tags=["status"]
+    )
+
+    @router.get("/")
+    def get_status() -> dict[str, Any]:
+        return {name: source() for name, source in status_sources.items()}
+
+    return router
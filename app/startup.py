@@ -0,0 +1,49 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+# module import time is the closest approximation of the process start that does not need extra dependencies
+_PROCESS_START = time.perf_counter()
+
+
+class StartupMonitor:
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+        self.ready: threading.Event = threading.Event()
+        self.error: str | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            logger.info(f"startup phase {name}: {self.phases[name]:.2f}s")
+
+    def set_ready(self):
+        self.phases['time_to_ready'] = time.perf_counter() - _PROCESS_START
+        self.ready.set()
+        logger.info(f"ready after {self.phases['time_to_ready']:.2f}s")
+
+    def set_failed(self, error: str):
+        self.error = error
+        logger.error(f"startup failed: {error}")
+
+    def run_in_background(self, name: str, target):
+        def run():
+            try:
+                with self.phase(name):
+                    target()
+            except Exception as e:
+                self.set_failed(f"{name}: {e}")
+                return
+            self.set_ready()
+
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+
+    def status(self) -> dict:
+        return {'ready': self.ready.is_set(), 'error': self.error,
+                'phases': {name: round(duration, 3) for name, duration in self.phases.items()}}
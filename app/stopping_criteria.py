@@ -0,0 +1,12 @@
+import torch
+from transformers import StoppingCriteria
+
+
+class KeywordsStoppingCriteria(StoppingCriteria):
+    def __init__(self, keywords_ids: list):
+        self.keywords_ids = keywords_ids
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if input_ids[0][-1] in self.keywords_ids:
+            return True
+        return False
@@ -14,6 +14,33 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--ssl-keyfile', type=str)
     parser.add_argument('--dry-run', action='store_true')
     parser.add_argument('--device', type=str, default="")
+    parser.add_argument('--layer-report', action='store_true')
+    parser.add_argument('--warmup', action='store_true')
+    parser.add_argument('--prompt-buckets', type=int, nargs='+', default=[])
+    parser.add_argument('--kv-cache-budget', type=float, default=0.0, help="GB, 0 means unlimited")
+    parser.add_argument('--kv-block-size', type=int, default=16)
+    parser.add_argument('--kv-cache-dtype', type=str, choices=['auto', 'int8'], default='auto')
+    parser.add_argument('--kv-prompt-truncation', type=int, default=0,
+                        help="tokens of prompt plus completion, older prompt tokens are dropped; 0 disables it")
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--cores-per-replica', type=int, default=0)
+    parser.add_argument('--models', type=str, nargs='+', default=[],
+                        help="additional models clients may request, besides --pretrained")
+    parser.add_argument('--max-resident-models', type=int, default=1)
+    parser.add_argument('--model-memory-budget', type=float, default=0.0, help="GB, 0 means unlimited")
+    parser.add_argument('--offload-evicted-models', action='store_true')
+    parser.add_argument('--embedding-model', type=str, default='mpnet-v2')
+    parser.add_argument('--embedding-device', type=str, default='cpu')
+    parser.add_argument('--embeddings-endpoint', action='store_true')
+    parser.add_argument('--embedding-batch-size', type=int, default=32)
+    parser.add_argument('--embedding-max-length', type=int, default=0,
+                        help="tokens per embedding input, 0 means the model's maximum")
+    parser.add_argument('--semantic-cache', action='store_true')
+    parser.add_argument('--semantic-cache-threshold', type=float, default=0.95)
+    parser.add_argument('--semantic-cache-size', type=int, default=4096)
+    parser.add_argument('--gateway-backends', type=str, nargs='+', default=[])
+    parser.add_argument('--trusted-proxies', type=str, nargs='+', default=[],
+                        help="gateway addresses whose x-forwarded-for header identifies the client")
     return parser
 
 
@@ -40,6 +67,8 @@ class ConfigModel(BaseModel):
 
 class ApiConfig(ConfigModel):
     auth_prefix: str
+    gateway_backends: list[str] = []
+    trusted_proxies: list[str] = []
 
 
 class ModelConfig(ConfigModel):
@@ -47,6 +76,27 @@ class ModelConfig(ConfigModel):
     bitsize: int = Field(alias="bit_precision")
     do_not_load_llm: bool = Field(alias="dry_run", default=False)
     device: str | None = None
+    layer_report: bool = False
+    warmup: bool = False
+    prompt_buckets: list[int] = []
+    kv_cache_budget: float = 0.0
+    kv_block_size: int = 16
+    kv_cache_dtype: str = 'auto'
+    kv_prompt_truncation: int = 0
+    replicas: int = 1
+    cores_per_replica: int = 0
+    models: list[str] = []
+    max_resident_models: int = 1
+    model_memory_budget: float = 0.0
+    offload_evicted_models: bool = False
+    embedding_model: str = 'mpnet-v2'
+    embedding_device: str = 'cpu'
+    embeddings_endpoint: bool = False
+    embedding_batch_size: int = 32
+    embedding_max_length: int = 0
+    semantic_cache: bool = False
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_size: int = 4096
 
 
 def get_config_from_arguments() -> tuple[ApiConfig, ModelConfig, ServerConfig]:
@@ -0,0 +1,216 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from app.util import ModelConfig
+
+_CODE_PROMPT = 'def fibonacci(n):'
+
+
+def run_requests(llm, num_requests: int, concurrency: int, max_new_tokens: int) -> float:
+    generation_config = {'max_new_tokens': max_new_tokens, 'do_sample': False}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: llm.generate(_CODE_PROMPT, generation_config), range(num_requests)))
+    return num_requests / (time.perf_counter() - start)
+
+
+def benchmark_replicas(args: argparse.Namespace):
+    from app.replica_pool import LlmReplicaPool
+
+    baseline = None
+    for replicas in range(1, args.max_replicas + 1):
+        model_config = ModelConfig(pretrained=args.pretrained, bit_precision=32, device='cpu', replicas=replicas)
+        pool = LlmReplicaPool(model_config)
+        try:
+            run_requests(pool, replicas, replicas, args.max_new_tokens)
+            throughput = run_requests(pool, args.requests, 2 * replicas, args.max_new_tokens)
+        finally:
+            pool.close()
+        baseline = baseline or throughput
+        print(f"replicas={replicas} throughput={throughput:.2f} req/s scaling={throughput / baseline:.2f}x")
+
+
+def wait_for(url: str, token: str, data: bytes | None, deadline: float) -> float:
+    request = urllib.request.Request(url, data=data, headers={'Authorization': f"Bearer {token}",
+                                                             'Content-Type': 'application/json'})
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.05)
+    raise TimeoutError(f"{url} did not answer in time")
+
+
+def benchmark_cold_start(args: argparse.Namespace):
+    url = f"http://127.0.0.1:{args.port}"
+    # argparse keeps the separator in front of the server arguments, later ones belong to the server
+    server_args = args.server_args[1:] if args.server_args[:1] == ['--'] else args.server_args
+    payload = json.dumps({'inputs': _CODE_PROMPT, 'parameters': {'max_new_tokens': 8}}).encode()
+    command = [sys.executable, '-m', 'app.main', '--pretrained', args.pretrained, '--port', str(args.port),
+               '--host', '127.0.0.1', '--auth-prefix', args.token, *server_args]
+    start = time.perf_counter()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + args.timeout
+        port_open = wait_for(f"{url}/health", args.token, None, deadline)
+        first_request = wait_for(f"{url}/api/generate/", args.token, payload, deadline)
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/health", headers={
+                'Authorization': f"Bearer {args.token}"})) as response:
+            phases = json.loads(response.read())['phases']
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"port open after {port_open - start:.2f}s, first request served after {first_request - start:.2f}s")
+    print(f"startup phases: {phases}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure_latencies(model_config: ModelConfig, num_requests: int) -> tuple[float, list[float]]:
+    from app.Llm import Llm
+
+    llm = Llm(model_config)
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(num_requests):
+        prompt = _CODE_PROMPT + '\n    a, b = b, a + b' * rng.randint(1, 40)
+        generation_config = {'max_new_tokens': rng.randint(4, 48), 'do_sample': False}
+        start = time.perf_counter()
+        llm.generate(prompt, generation_config)
+        latencies.append(time.perf_counter() - start)
+    return llm.warmup_time, latencies
+
+
+def benchmark_latency(args: argparse.Namespace):
+    for warmup in (False, True):
+        model_config = ModelConfig(pretrained=args.pretrained, bit_precision=32, device=args.device, warmup=warmup,
+                                   prompt_buckets=args.prompt_buckets if warmup else [])
+        # every configuration runs in a fresh process, so that it starts from cold kernels and allocators
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+            warmup_time, latencies = executor.submit(measure_latencies, model_config, args.requests).result()
+        print(f"warmup={warmup} warmup_time={warmup_time:.2f}s p50={percentile(latencies, 0.5) * 1000:.1f}ms "
+              f"p99={percentile(latencies, 0.99) * 1000:.1f}ms max={max(latencies) * 1000:.1f}ms")
+
+
+def benchmark_embeddings(args: argparse.Namespace):
+    from app.embeddings import Embedder
+
+    embedder = Embedder(args.embedding_model, args.device)
+    embedder.load()
+    rng = random.Random(0)
+    words = "the server caches completions for every client and answers code and chat requests".split()
+    texts = [" ".join(rng.choices(words, k=rng.randint(4, 200))) for _ in range(args.items)]
+    embedder.embed_batched(texts[:args.batch_size], args.batch_size)
+    start = time.perf_counter()
+    embedder.embed_batched(texts, args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"embedded {args.items} items in {elapsed:.2f}s: {args.items / elapsed:.1f} items/s "
+          f"(batch size {args.batch_size}, device {args.device})")
+
+
+def get_rss() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure_peak_memory(model_config: ModelConfig, prompt_tokens: int, max_new_tokens: int) -> tuple[int, int]:
+    from app.Llm import Llm
+
+    llm = Llm(model_config)
+    token_ids = (llm.tokenizer.encode(_CODE_PROMPT + '\n    a, b = b, a + b') * prompt_tokens)[:prompt_tokens]
+    generation_config = {'max_new_tokens': max_new_tokens, 'do_sample': False, 'min_new_tokens': max_new_tokens}
+    llm.generate_from_token_ids(token_ids[:8], generation_config, [])
+    baseline = peak = get_rss()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, get_rss())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    llm.generate_from_token_ids(token_ids, generation_config, [])
+    done.set()
+    sampler.join()
+    estimate = (prompt_tokens + max_new_tokens) * (llm.kv_bytes_per_token or 0)
+    return peak - baseline, estimate
+
+
+def benchmark_kv_memory(args: argparse.Namespace):
+    model_config = ModelConfig(pretrained=args.pretrained, bit_precision=32, device='cpu',
+                               kv_cache_budget=args.kv_cache_budget, kv_cache_dtype=args.kv_cache_dtype,
+                               kv_prompt_truncation=args.kv_prompt_truncation)
+    for prompt_tokens in args.prompt_tokens:
+        # a fresh process per size, so that the allocator does not reuse the memory of the previous request
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+            peak, estimate = executor.submit(measure_peak_memory, model_config, prompt_tokens,
+                                             args.max_new_tokens).result()
+        print(f"prompt={prompt_tokens} new={args.max_new_tokens} peak={peak / 1024 ** 2:.1f}MB "
+              f"kv_estimate={estimate / 1024 ** 2:.1f}MB")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained', type=str, default='testing')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    replicas_parser = subparsers.add_parser('replicas')
+    replicas_parser.add_argument('--max-replicas', type=int, default=4)
+    replicas_parser.add_argument('--requests', type=int, default=64)
+    replicas_parser.add_argument('--max-new-tokens', type=int, default=32)
+    replicas_parser.set_defaults(func=benchmark_replicas)
+
+    latency_parser = subparsers.add_parser('latency')
+    latency_parser.add_argument('--device', type=str, default='cpu')
+    latency_parser.add_argument('--requests', type=int, default=200)
+    latency_parser.add_argument('--prompt-buckets', type=int, nargs='+', default=[64, 128, 256, 512])
+    latency_parser.set_defaults(func=benchmark_latency)
+
+    embeddings_parser = subparsers.add_parser('embeddings')
+    embeddings_parser.add_argument('--embedding-model', type=str, default='mpnet-v2')
+    embeddings_parser.add_argument('--device', type=str, default='cpu')
+    embeddings_parser.add_argument('--items', type=int, default=1024)
+    embeddings_parser.add_argument('--batch-size', type=int, default=32)
+    embeddings_parser.set_defaults(func=benchmark_embeddings)
+
+    kv_memory_parser = subparsers.add_parser('kv-memory')
+    kv_memory_parser.add_argument('--prompt-tokens', type=int, nargs='+', default=[64, 128, 256, 512, 896])
+    kv_memory_parser.add_argument('--max-new-tokens', type=int, default=64)
+    kv_memory_parser.add_argument('--kv-cache-budget', type=float, default=0.0)
+    kv_memory_parser.add_argument('--kv-cache-dtype', type=str, choices=['auto', 'int8'], default='auto')
+    kv_memory_parser.add_argument('--kv-prompt-truncation', type=int, default=0)
+    kv_memory_parser.set_defaults(func=benchmark_kv_memory)
+
+    cold_start_parser = subparsers.add_parser('cold-start')
+    cold_start_parser.add_argument('--port', type=int, default=8765)
+    cold_start_parser.add_argument('--token', type=str, default='benchmark')
+    cold_start_parser.add_argument('--timeout', type=float, default=1800)
+    cold_start_parser.add_argument('server_args', nargs=argparse.REMAINDER)
+    cold_start_parser.set_defaults(func=benchmark_cold_start)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,12 @@
+import json
+import multiprocessing as mp
+import threading
 import unittest
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
 
 class TestGenerator(unittest.TestCase):
    def test_starcoder(self):
@@ -8,5 +16,397 @@ class TestGenerator(unittest.TestCase):
         print(g('def fibonacci(n):', {'max_new_tokens': 10}))
 
 
+class TestPromptBuckets(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from app.Llm import Llm
+        from app.util import ModelConfig
+
+        cls.llm = Llm(ModelConfig(pretrained='testing', bit_precision=32, device='cpu', prompt_buckets=[32, 64]))
+        cls.token_ids = cls.llm.tokenizer.encode('def fibonacci(n):\n    if n < 2:')
+
+    def get_inputs(self):
+        import torch
+        input_ids = torch.tensor([self.token_ids])
+        return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}
+
+    def test_prompts_are_left_padded_to_the_bucket(self):
+        padded_inputs, padding = self.llm.pad_to_bucket(self.get_inputs(), generation_tokens=8)
+        self.assertEqual(padding, 32 - len(self.token_ids))
+        self.assertEqual(tuple(padded_inputs['input_ids'].shape), (1, 32))
+        self.assertEqual(padded_inputs['input_ids'][0, padding:].tolist(), self.token_ids)
+        self.assertEqual(padded_inputs['attention_mask'][0].tolist(), [0] * padding + [1] * len(self.token_ids))
+
+    def test_padding_leaves_room_for_the_generated_tokens(self):
+        with mock.patch.object(self.llm, 'max_position_embeddings', 40):
+            padded_inputs, padding = self.llm.pad_to_bucket(self.get_inputs(), generation_tokens=16)
+            self.assertEqual(tuple(padded_inputs['input_ids'].shape), (1, 24))
+        with mock.patch.object(self.llm, 'max_position_embeddings', len(self.token_ids) + 4):
+            inputs = self.get_inputs()
+            self.assertEqual(self.llm.pad_to_bucket(inputs, generation_tokens=8), (inputs, 0))
+
+    def test_no_padding_without_buckets(self):
+        inputs = self.get_inputs()
+        with mock.patch.object(self.llm, 'prompt_buckets', []):
+            self.assertEqual(self.llm.pad_to_bucket(inputs, generation_tokens=8), (inputs, 0))
+
+    def test_padding_does_not_change_greedy_outputs(self):
+        generation_config = {'max_new_tokens': 8, 'do_sample': False}
+        bucketed = self.llm.generate_from_token_ids(self.token_ids, dict(generation_config), [])
+        with mock.patch.object(self.llm, 'prompt_buckets', []):
+            unbucketed = self.llm.generate_from_token_ids(self.token_ids, dict(generation_config), [])
+        self.assertEqual(bucketed, unbucketed)
+
+    def test_padding_stays_within_the_kv_cache_budget(self):
+        from app.kv_cache import KvCacheManager
+
+        kv_cache_manager = KvCacheManager(96 * self.llm.kv_bytes_per_token, block_size=16)
+        long_prompt = (self.token_ids * 10)[:87]
+        with mock.patch.object(self.llm, 'kv_cache_manager', kv_cache_manager), \
+                mock.patch.object(self.llm, 'prompt_buckets', [128]):
+            generation_config = {'max_new_tokens': 4, 'min_new_tokens': 4, 'do_sample': False}
+            bucketed = self.llm.generate_from_token_ids(long_prompt, dict(generation_config), [], False)
+            # padding must not shorten the answer of a short prompt either
+            generation_config = {'max_new_tokens': 90, 'min_new_tokens': 90, 'do_sample': False}
+            short = self.llm.generate_from_token_ids(self.token_ids[:6], dict(generation_config), [], False)
+        # a rejected request would answer with the error message instead of the prompt and 4 new tokens
+        self.assertEqual(bucketed[0][:87], long_prompt)
+        self.assertEqual(len(bucketed[0]), 87 + 4)
+        self.assertEqual(len(short[0]), 6 + 90)
+        self.assertEqual(kv_cache_manager.reserved_bytes, 0)
+
+        with mock.patch.object(self.llm, 'kv_cache_manager', kv_cache_manager), \
+                mock.patch.object(self.llm, 'prompt_buckets', []):
+            unbucketed = self.llm.generate_from_token_ids(long_prompt, {'max_new_tokens': 4, 'min_new_tokens': 4,
+                                                                       'do_sample': False}, [], False)
+        self.assertEqual(bucketed, unbucketed)
+
+
+class RecordingBackend(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.received.append({k.lower(): v for k, v in self.headers.items()})
+        self.rfile.read(int(self.headers['content-length']))
+        content = json.dumps({'generated_text': 'ok', 'status': 200, 'id': '1'}).encode()
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGateway(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingBackend)
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_two_clients_keep_their_identity(self):
+        from app.gateway import Gateway
+        from app.request_handler import ClientRequest
+
+        gateway = Gateway([f"http://127.0.0.1:{self.server.server_port}"], 'token')
+        headers = {'authorization': 'Bearer token', 'content-type': 'application/json'}
+        for client_host in ('10.0.0.1', '10.0.0.2'):
+            client_id = 'token' + client_host
+            status, _, _ = gateway.forward(client_id, client_host, '/api/generate/', b'{"inputs": "x"}', headers)
+            self.assertEqual(status, 200)
+
+        gateway_host = SimpleNamespace(host='127.0.0.1')
+        client_ids = {ClientRequest.get_client_id(SimpleNamespace(_headers=received, client=gateway_host),
+                                                  frozenset({'127.0.0.1'}))
+                      for received in self.server.received}
+        self.assertEqual(client_ids, {'token10.0.0.1', 'token10.0.0.2'})
+
+    def test_forwarded_host_is_only_trusted_from_proxies(self):
+        from app.request_handler import ClientRequest
+
+        request = SimpleNamespace(_headers={'authorization': 'Bearer token', 'x-forwarded-for': '10.0.0.9'},
+                                  client=SimpleNamespace(host='10.0.0.1'))
+        self.assertEqual(ClientRequest.get_client_id(request), 'token10.0.0.1')
+        self.assertEqual(ClientRequest.get_client_id(request, frozenset({'10.0.0.2'})), 'token10.0.0.1')
+        self.assertEqual(ClientRequest.get_client_id(request, frozenset({'10.0.0.1'})), 'token10.0.0.9')
+
+    def test_rank_backends_affinity_and_imbalance(self):
+        from app.gateway import Gateway
+
+        gateway = Gateway(['http://a:1', 'http://b:1', 'http://c:1'], 'token')
+        affine = gateway.rank_backends('client')[0]
+        self.assertIs(gateway.rank_backends('client')[0], affine)
+
+        affine.queue_depth = Gateway.max_imbalance
+        self.assertIs(gateway.rank_backends('client')[0], affine)
+        affine.queue_depth = Gateway.max_imbalance + 1
+        self.assertIsNot(gateway.rank_backends('client')[0], affine)
+
+        affine.queue_depth = 0
+        affine.healthy = False
+        self.assertNotIn(affine, gateway.rank_backends('client'))
+
+
+class FakeReplica:
+    def __init__(self, index: int, in_flight: int = 0, healthy: bool = True, dies: bool = False):
+        self.index = index
+        self.in_flight = in_flight
+        self.healthy = healthy
+        self.dies = dies
+        self.requests = 0
+
+    def request(self, header: dict, token_ids: list):
+        self.requests += 1
+        if self.dies:
+            self.healthy = False
+            raise RuntimeError(f"replica {self.index} failed: EOFError")
+        return {'type': 'result', 'prompt_tokens': len(token_ids), 'completion_tokens': 1}, array('q', [self.index])
+
+
+class TestReplicaPool(unittest.TestCase):
+    def get_pool(self, replicas: list):
+        from app.replica_pool import LlmReplicaPool
+
+        pool = LlmReplicaPool.__new__(LlmReplicaPool)
+        pool.lock = threading.Lock()
+        pool.stop_ids = []
+        pool.replicas = replicas
+        pool.tokenizer = mock.Mock(return_value={'input_ids': [1, 2, 3]},
+                                   decode=lambda token_ids: f"replica {token_ids[0]}")
+        return pool
+
+    def test_messages_round_trip(self):
+        from app.replica_pool import send_message, recv_message
+
+        parent_conn, child_conn = mp.Pipe()
+        send_message(parent_conn, {'type': 'generate', 'stop_ids': [0]}, [1, 2 ** 40, -3])
+        header, token_ids = recv_message(child_conn)
+        self.assertEqual(header, {'type': 'generate', 'stop_ids': [0]})
+        self.assertEqual(token_ids.tolist(), [1, 2 ** 40, -3])
+        send_message(child_conn, {'type': 'pong'})
+        self.assertEqual(recv_message(parent_conn)[1].tolist(), [])
+
+    def test_split_cores(self):
+        from app.replica_pool import split_cores
+
+        with mock.patch('os.sched_getaffinity', return_value={0, 1, 2, 3, 4, 5, 6, 7}):
+            self.assertEqual(split_cores(3), [[0, 1], [2, 3], [4, 5]])
+            self.assertEqual(split_cores(2, cores_per_replica=3), [[0, 1, 2], [3, 4, 5]])
+            # oversubscribed replicas wrap around and share cores
+            self.assertEqual(split_cores(3, cores_per_replica=4), [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]])
+
+    def test_least_loaded_healthy_replica_is_chosen(self):
+        replicas = [FakeReplica(0, in_flight=2), FakeReplica(1, in_flight=0, healthy=False),
+                    FakeReplica(2, in_flight=1)]
+        pool = self.get_pool(replicas)
+        replica = pool.acquire_replica()
+        self.assertIs(replica, replicas[2])
+        self.assertEqual(replica.in_flight, 2)
+        pool.release_replica(replica)
+        self.assertEqual(replica.in_flight, 1)
+
+        for replica in replicas:
+            replica.healthy = False
+        self.assertRaises(RuntimeError, pool.acquire_replica)
+
+    def test_request_is_retried_on_another_replica(self):
+        replicas = [FakeReplica(0, dies=True), FakeReplica(1, in_flight=1)]
+        pool = self.get_pool(replicas)
+        self.assertEqual(pool.generate('def f():', {'max_new_tokens': 4}), ("replica 1", 3, 1))
+        self.assertFalse(replicas[0].healthy)
+        self.assertEqual([replica.in_flight for replica in replicas], [0, 1])
+
+    def test_failure_of_the_retry_is_raised(self):
+        pool = self.get_pool([FakeReplica(0, dies=True), FakeReplica(1, dies=True)])
+        self.assertRaises(RuntimeError, pool.generate, 'def f():', {'max_new_tokens': 4})
+
+
+class TestEmbeddings(unittest.TestCase):
+    def get_stream(self, embeddings, encoding_format: str, chunk_size: int) -> list:
+        from app.routers.embeddings import encode_embeddings
+
+        chunks = list(encode_embeddings(embeddings, encoding_format, chunk_size))
+        return json.loads("[" + "".join(chunks) + "]")
+
+    def test_chunked_stream_is_valid_json(self):
+        import torch
+
+        embeddings = torch.arange(15, dtype=torch.float).reshape(5, 3)
+        for chunk_size in (1, 2, 5, 8):
+            data = self.get_stream(embeddings, "float", chunk_size)
+            self.assertEqual([item['index'] for item in data], list(range(5)))
+            self.assertEqual([item['embedding'] for item in data], embeddings.tolist())
+
+    def test_base64_round_trips_to_float(self):
+        import base64
+        import numpy
+        import torch
+
+        embeddings = torch.randn(4, 8)
+        floats = self.get_stream(embeddings, "float", 3)
+        encoded = self.get_stream(embeddings, "base64", 3)
+        for float_item, base64_item in zip(floats, encoded):
+            decoded = numpy.frombuffer(base64.b64decode(base64_item['embedding']), dtype=numpy.float32)
+            self.assertEqual(decoded.tolist(), float_item['embedding'])
+
+    def test_batches_are_returned_in_request_order(self):
+        import torch
+        from app.embeddings import Embedder
+
+        embedder = Embedder('mpnet-v2')
+        texts = ["def fibonacci(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a",
+                 "class Foo:", "import os", "the server caches completions for every client", "x"]
+        embeddings, total_tokens, truncated = embedder.embed_batched(texts, batch_size=2)
+        expected = torch.cat([embedder.embed([text]) for text in texts])
+        self.assertTrue(torch.allclose(embeddings, expected, atol=1e-5))
+        self.assertEqual(total_tokens, sum(len(embedder.tokenizer(text)['input_ids']) for text in texts))
+        self.assertEqual(truncated, 0)
+
+
+class FakeLlm:
+    def __init__(self, footprint: int):
+        self.footprint = footprint
+        self.loaded = False
+        self.offload_device = None
+
+    def load_model(self, bitsize):
+        self.loaded = True
+
+    def unload_model(self, offload_to_cpu: bool = False):
+        self.loaded = False
+
+    def memory_footprint(self) -> int:
+        return self.footprint if self.loaded else 0
+
+
+class TestModelManager(unittest.TestCase):
+    def get_manager(self, **kwargs):
+        from app.model_manager import ModelManager
+        from app.util import ModelConfig
+
+        config = ModelConfig(pretrained='testing', bit_precision=32, device='cpu',
+                             models=['starcoder', 'llama2'], **kwargs)
+        manager = ModelManager(config)
+        footprints = {'testing': 1024 ** 3, 'starcoder': 2 * 1024 ** 3, 'llama2': 3 * 1024 ** 3}
+        manager.create_llm = lambda model_name: FakeLlm(footprints[model_name])
+        return manager
+
+    def test_resolve_only_allowed_models(self):
+        manager = self.get_manager()
+        self.assertEqual(manager.resolve('starcoder'), 'starcoder')
+        self.assertEqual(manager.resolve('bigcode/starcoder'), 'starcoder')
+        self.assertEqual(manager.resolve('falcon-large'), 'testing')
+        self.assertEqual(manager.resolve(None), 'testing')
+
+    def test_lru_eviction(self):
+        manager = self.get_manager(max_resident_models=2)
+        for model_name in ('testing', 'starcoder', 'testing', 'llama2'):
+            manager.acquire(model_name)
+            manager.release(model_name)
+        self.assertEqual(list(manager.resident), ['testing', 'llama2'])
+        self.assertFalse(manager.llms['starcoder'].loaded)
+        self.assertEqual(manager.stats['starcoder'].evictions, 1)
+
+    def test_models_in_use_are_not_evicted(self):
+        manager = self.get_manager(max_resident_models=1)
+        manager.acquire('testing')
+        manager.acquire('starcoder')
+        self.assertEqual(list(manager.resident), ['testing', 'starcoder'])
+        manager.release('testing')
+        manager.release('starcoder')
+        manager.acquire('llama2')
+        self.assertEqual(list(manager.resident), ['llama2'])
+
+    def test_memory_budget_eviction(self):
+        manager = self.get_manager(max_resident_models=3, model_memory_budget=4.0)
+        for model_name in ('testing', 'starcoder', 'llama2'):
+            manager.acquire(model_name)
+            manager.release(model_name)
+        self.assertEqual(list(manager.resident), ['llama2'])
+        self.assertLessEqual(manager.resident_memory(), 4 * 1024 ** 3)
+
+    def test_memory_budget_is_ignored_with_replicas(self):
+        manager = self.get_manager(model_memory_budget=4.0, replicas=2)
+        self.assertEqual(manager.memory_budget, 0)
+
+
+class TestSemanticIndex(unittest.TestCase):
+    def test_ring_buffer_wraps_around(self):
+        import torch
+        from app.request_handler import SemanticIndex
+
+        index = SemanticIndex(max_entries=2)
+        embeddings = torch.eye(3)
+        for i in range(3):
+            index.add(embeddings[i], f"answer {i}", context=0)
+        self.assertEqual(index.size, 2)
+        self.assertEqual(index.next, 1)
+        # the oldest answer was overwritten by the third one
+        score, answer = index.search(embeddings[0], context=0)
+        self.assertEqual(score, 0.0)
+        self.assertNotEqual(answer, 'answer 0')
+        self.assertEqual(index.search(embeddings[2], context=0), (1.0, 'answer 2'))
+        self.assertEqual(index.search(embeddings[1], context=0), (1.0, 'answer 1'))
+
+    def test_other_contexts_do_not_match(self):
+        import torch
+        from app.request_handler import SemanticIndex
+
+        index = SemanticIndex(max_entries=4)
+        index.add(torch.ones(3), 'answer', context=1)
+        self.assertEqual(index.search(torch.ones(3), context=2), (0.0, None))
+        # a better match given in another context does not shadow the one of the same context
+        index.add(torch.tensor([1.0, 0.0, 0.0]), 'same context', context=2)
+        self.assertEqual(index.search(torch.ones(3), context=2), (1.0, 'same context'))
+
+
+class TestKvCacheManager(unittest.TestCase):
+    def test_reservations_are_rounded_to_blocks(self):
+        from app.kv_cache import KvCacheManager
+
+        manager = KvCacheManager(budget_bytes=640, block_size=16)
+        self.assertEqual(manager.get_blocks(17), 2)
+        self.assertEqual(manager.get_reservation_bytes(17, bytes_per_token=4), 128)
+        self.assertEqual(manager.get_max_tokens(bytes_per_token=4), 160)
+
+    def test_reserve_never_exceeds_the_budget(self):
+        from app.kv_cache import KvCacheManager
+
+        manager = KvCacheManager(budget_bytes=640, block_size=16)
+        first = manager.reserve(96, bytes_per_token=4)
+        self.assertEqual(first, 384)
+        self.assertIsNone(manager.reserve(80, bytes_per_token=4))
+        second = manager.reserve(64, bytes_per_token=4)
+        self.assertEqual(manager.reserved_bytes, 640)
+        manager.release(first)
+        manager.release(second)
+        self.assertEqual(manager.reserved_bytes, 0)
+        self.assertEqual(manager.status()['admitted'], 2)
+        self.assertEqual(manager.status()['rejected'], 1)
+
+    def test_int8_cache_only_needs_the_quantized_cache(self):
+        from app.kv_cache import get_quantized_cache_config
+
+        expected = {'cache_implementation': 'quantized', 'cache_config': {'backend': 'HQQ', 'nbits': 8}}
+        # transformers 5 has QuantizedCache, but no longer QuantizedCacheConfig
+        with mock.patch.dict('sys.modules', transformers=SimpleNamespace(QuantizedCache=object)), \
+                mock.patch('importlib.util.find_spec', return_value=object()):
+            self.assertEqual(get_quantized_cache_config('int8'), expected)
+            self.assertEqual(get_quantized_cache_config('auto'), {})
+        with mock.patch.dict('sys.modules', transformers=SimpleNamespace()):
+            self.assertEqual(get_quantized_cache_config('int8'), {})
+
+    def test_no_budget_means_no_manager(self):
+        from app.kv_cache import KvCacheManager
+        from app.util import ModelConfig
+
+        config = ModelConfig(pretrained='testing', bit_precision=32)
+        self.assertIsNone(KvCacheManager.from_config(config))
+        self.assertIsNotNone(KvCacheManager.from_config(config.model_copy(update={'kv_cache_budget': 1.0})))
+
+
 if __name__ == '__main__':
     unittest.main()